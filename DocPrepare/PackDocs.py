@@ -0,0 +1,216 @@
+from PrepareDocs import PrepareDocs
+
+import gzip
+import json
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class GzipCodec:
+    """ Compresses blocks as independent gzip members """
+
+    extension = '.jsonl.gz'
+
+    def compress(self, data):
+        return gzip.compress(data)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+
+class ZstdCodec:
+    """ Compresses blocks as independent zstd frames """
+
+    extension = '.jsonl.zst'
+
+    def __init__(self, level=3):
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+
+def get_codec(name=None):
+    """ Returns a codec by name, defaulting to zstd when zstandard is
+    installed and gzip otherwise """
+
+    if name is None:
+        name = 'zstd' if zstandard else 'gzip'
+    if name == 'zstd':
+        return ZstdCodec()
+    return GzipCodec()
+
+
+class ShardWriter:
+    """ Writes records as JSON lines into compressed shard files. Records
+    are compressed in blocks so that a single document can be read back by
+    decompressing only its block. The block offsets are saved in
+    index.json. """
+
+    def __init__(self, directory, codec=None, block_size=64,
+                 shard_bytes=64 * 1024 * 1024):
+
+        self.directory = directory
+        self.codec = codec or get_codec()
+        self.block_size = block_size
+        self.shard_bytes = shard_bytes
+        self.index = {
+            'codec': self.codec.extension, 'shards': [], 'blocks': [],
+            'documents': {}}
+        self.block = []
+        self.shard = None
+        os.makedirs(directory, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open_shard(self):
+        """ Starts a new shard file """
+
+        if self.shard:
+            self.shard.close()
+        shard_name = 'shard-%05d%s' % (
+            len(self.index['shards']), self.codec.extension)
+        self.index['shards'].append(shard_name)
+        self.shard = open(os.path.join(self.directory, shard_name), 'wb')
+
+    def write(self, doc_id, record):
+        """ Adds a record to the current block """
+
+        self.index['documents'][doc_id] = [
+            len(self.index['blocks']), len(self.block)]
+        self.block.append(json.dumps(record, ensure_ascii=False))
+        if len(self.block) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        """ Compresses the current block and appends it to the shard """
+
+        if not self.block:
+            return
+        if not self.shard or self.shard.tell() >= self.shard_bytes:
+            self.open_shard()
+        data = self.codec.compress(
+            ('\n'.join(self.block) + '\n').encode('utf-8'))
+        self.index['blocks'].append([
+            len(self.index['shards']) - 1, self.shard.tell(), len(data)])
+        self.shard.write(data)
+        self.block = []
+
+    def close(self):
+        """ Flushes remaining records and writes the index """
+
+        self.flush()
+        if self.shard:
+            self.shard.close()
+            self.shard = None
+        with open(os.path.join(self.directory, 'index.json'), 'w') as f:
+            json.dump(self.index, f)
+
+
+class ShardReader:
+    """ Reads records written by ShardWriter, either one document at a time
+    by id or by streaming whole shards """
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        with open(os.path.join(directory, 'index.json'), 'r') as f:
+            self.index = json.load(f)
+        self.codec = ZstdCodec() if self.index['codec'].endswith('.zst') \
+            else GzipCodec()
+
+    def read_block(self, block_number):
+        """ Returns the decompressed lines of one block """
+
+        shard_number, offset, length = self.index['blocks'][block_number]
+        shard_path = os.path.join(
+            self.directory, self.index['shards'][shard_number])
+        with open(shard_path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        return self.codec.decompress(data).decode('utf-8').splitlines()
+
+    def get(self, doc_id):
+        """ Returns the record of a single document """
+
+        block_number, line = self.index['documents'][doc_id]
+        return json.loads(self.read_block(block_number)[line])
+
+    def __iter__(self):
+        """ Streams every record, one shard after another """
+
+        for shard_number, shard_name in enumerate(self.index['shards']):
+            blocks = [
+                block for block in self.index['blocks']
+                if block[0] == shard_number]
+            with open(os.path.join(self.directory, shard_name), 'rb') as f:
+                for block_shard, offset, length in blocks:
+                    f.seek(offset)
+                    data = self.codec.decompress(f.read(length))
+                    for line in data.decode('utf-8').splitlines():
+                        yield json.loads(line)
+
+
+class PackDocs(PrepareDocs):
+    """ Packs extracted text and normalized metadata of each time-stamped
+    directory into compressed shards, so downstream indexing can stream a
+    few large files instead of millions of small ones """
+
+    def __init__(self, agency_directory, output_directory,
+                 custom_parser=None, codec=None, block_size=64,
+                 shard_bytes=64 * 1024 * 1024):
+
+        super().__init__(agency_directory, custom_parser)
+        self.output_directory = output_directory
+        self.codec = codec
+        self.block_size = block_size
+        self.shard_bytes = shard_bytes
+
+    def read_text(self, root, base_file):
+        """ Returns extracted text of a document, if any """
+
+        text_file = os.path.join(root, base_file + '.txt')
+        if os.path.exists(text_file):
+            with open(text_file, 'r') as f:
+                return f.read()
+
+    def pack_directory(self, directory_path):
+        """ Packs every document in a folder into shards, indexed by the
+        document's folder and base file name """
+
+        output_path = os.path.join(
+            self.output_directory,
+            self.agency_name(),
+            os.path.split(directory_path)[-1])
+        writer = ShardWriter(
+            output_path, codec=get_codec(self.codec),
+            block_size=self.block_size, shard_bytes=self.shard_bytes)
+        with writer:
+            for root, base_file, metadata in \
+                    self.collect_metadata(directory_path):
+                # Not from doc_location, as file types may hold dots or /
+                doc_id = os.path.join(os.path.split(root)[-1], base_file)
+                record = dict(metadata, id=doc_id)
+                record['text'] = self.read_text(root, base_file)
+                writer.write(doc_id, record)
+
+    def prepare_documents(self):
+        """ Looks for time-stamped directories inside an agency directory and
+        packs each one into shards """
+
+        for directory_path in self.time_stamped_directories():
+            self.pack_directory(directory_path=directory_path)
+        if self.profiler:
+            self.profiler.report()
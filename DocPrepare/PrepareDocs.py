@@ -1,22 +1,61 @@
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import logging
 import os
+import threading
 import json
 import yaml
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class PrepareDocs:
 
-    def __init__(self, agency_directory, custom_parser=None, s3_bucket=None):
+    # Files larger than this are uploaded to s3 in parts of MULTIPART_CHUNK
+    MULTIPART_THRESHOLD = 64 * 1024 * 1024
+    MULTIPART_CHUNK = 16 * 1024 * 1024
+    # Normalized metadata fields and the Tika keys they are read from
+    TIKA_FIELDS = (
+        ('file_type', 'dc:format'),
+        ('date_released', 'Last-Save-Date'),
+        ('title', 'title'),
+        ('pages', 'xmpTPg:NPages'),
+        ('date_created', 'meta:creation-date'),
+    )
+
+    def __init__(self, agency_directory, custom_parser=None, s3_bucket=None,
+                 duplicate_index=None, catalog=None, s3_sync=True,
+                 upload_workers=4, profiler=None):
         """
         agency_directory: directory of a specific office or agency
         custom_parser: optional parser function for document metadata
         not extracted with Tika
+        duplicate_index: optional NearDuplicateIndex used to flag
+        near-duplicate documents in the manifest
+        catalog: optional MetadataCatalog that caches normalized metadata
+        and backs create_manifest_from_catalog
+        s3_sync: only upload files that are new or changed in s3
+        upload_workers: number of concurrent s3 uploads
+        profiler: optional DocumentProfiler that profiles the metadata of
+        each document and reports slow documents after prepare_documents
         """
         self.agency_directory = agency_directory
         self.custom_parser = custom_parser
+        self.duplicate_index = duplicate_index
+        self.catalog = catalog
+        self.s3_sync = s3_sync
+        self.upload_workers = upload_workers
+        self.profiler = profiler
+        self.remote_files = None
+        self.upload_local = threading.local()
 
         if s3_bucket:
+            from boto.s3.connection import S3Connection
             self.s3_bucket = S3Connection().get_bucket(s3_bucket)
         else:
             self.s3_bucket = None
@@ -36,9 +75,42 @@ class PrepareDocs:
 
         return file_type.replace('application/', '').split(';')[0].strip()
 
+    def first_value(self, value):
+        """ Tika returns repeated fields as lists. Returns the first value,
+        or None for an empty list """
+
+        if isinstance(value, list):
+            return value[0] if value else None
+        return value
+
+    def agency_name(self):
+        """ Returns the name of the agency directory """
+
+        return os.path.split(self.agency_directory.rstrip('/'))[-1]
+
+    def metadata_mtime(self, root, base_file):
+        """ Returns the latest modification time of a document's metadata
+        files, or None if the Tika metadata file is not on disk """
+
+        try:
+            mtime = os.path.getmtime(
+                os.path.join(root, base_file + "_metadata.json"))
+        except OSError:
+            return None
+        custom_file = os.path.join(root, base_file + ".json")
+        if self.custom_parser and os.path.exists(custom_file):
+            mtime = max(mtime, os.path.getmtime(custom_file))
+        return mtime
+
     def open_metadata_file(self, metadata_file):
         """ Opens a meta data file and converts to a dict """
 
+        if self.catalog and os.path.exists(metadata_file):
+            # The raw copy is only used while the file is unchanged
+            tika_metadata = self.catalog.get_raw(
+                metadata_file, os.path.getmtime(metadata_file))
+            if tika_metadata is not None:
+                return tika_metadata
         with open(metadata_file, 'r') as f:
             try:
                 tika_metadata = json.loads(f.read())
@@ -51,25 +123,102 @@ class PrepareDocs:
          containing file_type, date_released, title, pages, and date_created
         """
 
+        return self.normalize_record(self.open_metadata_file(metadata_file))
+
+    def normalize_record(self, tika_metadata):
+        """ Normalizes the fields of one Tika metadata dict """
+
         metadata = {}
-        tika_metadata = self.open_metadata_file(metadata_file)
         metadata['file_type'] = self.clean_tika_file_type(
-            tika_metadata.get('dc:format', ''))
+            self.first_value(tika_metadata.get('dc:format')) or '')
         metadata['date_released'] = self.parse_date(
-            tika_metadata.get('Last-Save-Date'))
-        metadata['title'] = tika_metadata.get('title')
-        metadata['pages'] = tika_metadata.get('xmpTPg:NPages')
+            self.first_value(tika_metadata.get('Last-Save-Date')))
+        metadata['title'] = self.first_value(tika_metadata.get('title'))
+        metadata['pages'] = self.first_value(
+            tika_metadata.get('xmpTPg:NPages'))
         metadata['date_created'] = self.parse_date(
-            tika_metadata.get('meta:creation-date'))
+            self.first_value(tika_metadata.get('meta:creation-date')))
 
         return metadata
 
+    def load_tika_metadata(self, raw):
+        """ Parses raw Tika JSON, with orjson when it is installed. Metadata
+        that cannot be read becomes an empty dict, as in open_metadata_file
+        """
+
+        try:
+            if orjson:
+                tika_metadata = orjson.loads(raw)
+            else:
+                if isinstance(raw, bytes):
+                    raw = raw.decode('utf-8')
+                tika_metadata = json.loads(raw)
+        except ValueError:
+            return {}
+        return tika_metadata if isinstance(tika_metadata, dict) else {}
+
+    def normalize_tika_metadata(self, records):
+        """ Normalizes many Tika metadata records at once. `records` may
+        hold dicts or raw JSON bytes. Returns a dict of columns, one list
+        per field in TIKA_FIELDS, in the order of the records. Gives the same
+        values as normalize_record, but in a single loop that keeps only the
+        fields of each parsed record, and file types are only cleaned once
+        per distinct value """
+
+        (type_key, released_key, title_key, pages_key,
+         created_key) = [key for field, key in self.TIKA_FIELDS]
+        file_types, released, titles, pages, created = [], [], [], [], []
+        cleaned = {}
+        load = self.load_tika_metadata
+        for record in records:
+            if not isinstance(record, dict):
+                record = load(record)
+            get = record.get
+
+            value = get(type_key)
+            if isinstance(value, list):
+                value = value[0] if value else None
+            try:
+                file_types.append(cleaned[value])
+            except KeyError:
+                cleaned[value] = self.clean_tika_file_type(value or '')
+                file_types.append(cleaned[value])
+
+            value = get(released_key)
+            if isinstance(value, list):
+                value = value[0] if value else None
+            released.append(value.partition('T')[0] if value else None)
+
+            value = get(title_key)
+            if isinstance(value, list):
+                value = value[0] if value else None
+            titles.append(value)
+
+            value = get(pages_key)
+            if isinstance(value, list):
+                value = value[0] if value else None
+            pages.append(value)
+
+            value = get(created_key)
+            if isinstance(value, list):
+                value = value[0] if value else None
+            created.append(value.partition('T')[0] if value else None)
+
+        return dict(zip(
+            [field for field, key in self.TIKA_FIELDS],
+            (file_types, released, titles, pages, created)))
+
     def prep_metadata(self, root, base_file):
         """ Prepares metadata from Tika metadata file and applies a unique
         parser to the data if available """
 
-        metadata = self.parse_tika_metadata(
-            metadata_file=os.path.join(root, base_file + "_metadata.json"))
+        metadata_file = os.path.join(root, base_file + "_metadata.json")
+        if self.catalog:
+            metadata = self.catalog.get_metadata(
+                metadata_file, self.metadata_mtime(root, base_file))
+            if metadata is not None:
+                return metadata
+        metadata = self.parse_tika_metadata(metadata_file=metadata_file)
         if self.custom_parser:
             metadata = self.custom_parser(
                 metadata_file=os.path.join(root, base_file + ".json"),
@@ -77,12 +226,106 @@ class PrepareDocs:
             )
         return metadata
 
-    def upload_file_to_s3(self, rel_file_loc, upload_file_loc):
-        """ Uploads individual document to s3 """
+    def upload_bucket(self):
+        """ Returns the s3 bucket for the current upload thread. Worker
+        threads open their own connection, since boto connections are not
+        safe to share between threads """
+
+        if threading.current_thread() is threading.main_thread():
+            return self.s3_bucket
+        if not hasattr(self.upload_local, 'bucket'):
+            conn = self.s3_bucket.connection
+            # The provider carries keys, session tokens and profiles, so
+            # temporary and instance role credentials keep working
+            thread_conn = conn.__class__(
+                provider=conn.provider, is_secure=conn.is_secure,
+                port=conn.port, host=conn.host, proxy=conn.proxy,
+                proxy_port=conn.proxy_port, proxy_user=conn.proxy_user,
+                proxy_pass=conn.proxy_pass,
+                calling_format=conn.calling_format,
+                bucket_class=conn.bucket_class, anon=conn.anon,
+                validate_certs=conn.https_validate_certificates)
+            self.upload_local.bucket = thread_conn.get_bucket(
+                self.s3_bucket.name, validate=False)
+        return self.upload_local.bucket
+
+    def list_remote_files(self, prefix):
+        """ Returns the size and ETag of every s3 object under a prefix from
+        a single listing """
+
+        return {
+            key.name: (key.size, key.etag.strip('"'))
+            for key in self.s3_bucket.list(prefix)}
+
+    def local_etag(self, file_loc):
+        """ Returns the ETag s3 reports for a file uploaded by
+        upload_file_to_s3, which is the MD5 of the file or, for multipart
+        uploads, the MD5 of the part MD5s followed by the number of parts """
+
+        size = os.path.getsize(file_loc)
+        multipart = size > self.MULTIPART_THRESHOLD
+        part_size = self.MULTIPART_CHUNK if multipart else max(size, 1)
+        parts = []
+        with open(file_loc, 'rb') as f:
+            for offset in range(0, max(size, 1), part_size):
+                part = hashlib.md5()
+                remaining = min(part_size, size - offset)
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        break
+                    part.update(chunk)
+                    remaining -= len(chunk)
+                parts.append(part)
+        if not multipart:
+            return parts[0].hexdigest()
+        combined = hashlib.md5(b''.join(part.digest() for part in parts))
+        return '%s-%d' % (combined.hexdigest(), len(parts))
+
+    def is_unchanged_in_s3(self, rel_file_loc, upload_file_loc):
+        """ Returns True if s3 already holds an identical copy of a file,
+        according to the listing in remote_files """
+
+        remote = self.remote_files.get(upload_file_loc)
+        if not remote or remote[0] != os.path.getsize(rel_file_loc):
+            return False
+        return remote[1] == self.local_etag(rel_file_loc)
+
+    def multipart_upload_to_s3(self, rel_file_loc, upload_file_loc):
+        """ Uploads a large file to s3 in parts """
+
+        upload = self.upload_bucket().initiate_multipart_upload(
+            upload_file_loc)
+        try:
+            with open(rel_file_loc, 'rb') as f:
+                part_num = 1
+                chunk = f.read(self.MULTIPART_CHUNK)
+                while chunk:
+                    upload.upload_part_from_file(
+                        io.BytesIO(chunk), part_num=part_num)
+                    part_num += 1
+                    chunk = f.read(self.MULTIPART_CHUNK)
+            upload.complete_upload()
+        except Exception:
+            upload.cancel_upload()
+            raise
 
-        k = Key(self.s3_bucket)
-        k.key = upload_file_loc
-        k.set_contents_from_filename(rel_file_loc, replace=True)
+    def upload_file_to_s3(self, rel_file_loc, upload_file_loc):
+        """ Uploads individual document to s3. When syncing, files that are
+        unchanged in s3 are skipped. Returns True if the file was uploaded """
+
+        if self.remote_files is not None and \
+                self.is_unchanged_in_s3(rel_file_loc, upload_file_loc):
+            logging.info("%s is unchanged in s3", upload_file_loc)
+            return False
+        if os.path.getsize(rel_file_loc) > self.MULTIPART_THRESHOLD:
+            self.multipart_upload_to_s3(rel_file_loc, upload_file_loc)
+        else:
+            from boto.s3.key import Key
+            k = Key(self.upload_bucket())
+            k.key = upload_file_loc
+            k.set_contents_from_filename(rel_file_loc, replace=True)
+        return True
 
     def upload_doc_to_s3(self, rel_doc_root, upload_doc_loc, doc_ext):
         """ Uploads an individual document and text file to s3 """
@@ -99,13 +342,20 @@ class PrepareDocs:
                 rel_file_loc=rel_doc_root + doc_ext,
                 upload_file_loc=upload_doc_loc + doc_ext)
 
+    def upload_directory(self, directory_path):
+        """ Returns the s3 location of a time-stamped directory """
+
+        return os.path.join(
+            os.path.split(self.agency_directory)[-1],
+            os.path.split(directory_path)[-1])
+
     def upload_folder_to_s3(self, manifest, directory_path):
         """ Uploads manifest to s3 and then iterates over documents in the
         manifest and uploads each to s3 """
 
-        upload_dir = os.path.join(
-            os.path.split(self.agency_directory)[-1],
-            os.path.split(directory_path)[-1])
+        upload_dir = self.upload_directory(directory_path)
+        if self.s3_sync:
+            self.remote_files = self.list_remote_files(upload_dir + '/')
 
         # Upload manifest
         self.upload_file_to_s3(
@@ -113,7 +363,7 @@ class PrepareDocs:
             upload_file_loc=os.path.join(upload_dir, 'manifest.yaml'))
 
         # Upload documents
-        for metadata in manifest:
+        def upload_doc(metadata):
             doc_root, doc_ext = os.path.splitext(metadata.get('doc_location'))
             rel_doc_root = os.path.join(directory_path, doc_root)
             self.upload_doc_to_s3(
@@ -121,6 +371,15 @@ class PrepareDocs:
                 upload_doc_loc=os.path.join(upload_dir, doc_root),
                 doc_ext=doc_ext)
 
+        if self.upload_workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.upload_workers) as executor:
+                list(executor.map(upload_doc, manifest))
+        else:
+            for metadata in manifest:
+                upload_doc(metadata)
+        self.remote_files = None
+
     def prepare_file_location(self, metadata, root, base_file):
         """ Adds file location to metadata so that manifest can correctly
         display it """
@@ -138,30 +397,111 @@ class PrepareDocs:
                 manifest,
                 default_flow_style=False, allow_unicode=True))
 
-    def create_manifest(self, directory_path):
-        """ Generates a document manifest for a specific folder """
+    def flag_near_duplicate(self, metadata, root, base_file):
+        """ Fingerprints the extracted text of a document and adds
+        `near_duplicate_of` to metadata when an earlier document matches """
+
+        text_file = os.path.join(root, base_file + '.txt')
+        if not os.path.exists(text_file):
+            return
+        with open(text_file, 'r') as f:
+            signature = self.duplicate_index.signature(f.read())
+        doc_id = os.path.join(
+            self.agency_name(),
+            os.path.relpath(os.path.join(root, base_file),
+                            self.agency_directory))
+        metadata.pop('near_duplicate_of', None)
+        match = self.duplicate_index.query(signature, doc_id)
+        if match:
+            metadata['near_duplicate_of'] = match
+        self.duplicate_index.add(doc_id, signature)
+
+    def document_metadata(self, directory_path, root, base_file):
+        """ Returns the manifest entry of one document in a time-stamped
+        directory """
+
+        metadata = self.prep_metadata(root=root, base_file=base_file)
+        self.prepare_file_location(metadata, root, base_file)
+        if self.duplicate_index:
+            self.flag_near_duplicate(metadata, root, base_file)
+        if self.catalog:
+            self.catalog.add(
+                os.path.join(root, base_file + '_metadata.json'),
+                self.agency_name(),
+                os.path.split(directory_path.rstrip('/'))[-1],
+                metadata, self.metadata_mtime(root, base_file))
+        return metadata
+
+    @contextlib.contextmanager
+    def profile(self, doc_id):
+        """ Profiles a document when a profiler is set """
+
+        if self.profiler is None:
+            yield
+        else:
+            with self.profiler.profile(doc_id) as document:
+                yield document
+
+    def collect_metadata(self, directory_path):
+        """ Walks a folder and yields the root, base file name, and prepared
+        metadata of every document with Tika metadata. Once the walk is
+        done, catalog rows of documents no longer in the folder are deleted
+        """
 
-        manifest = []
+        metadata_paths = []
         for root, dirs, files in os.walk(directory_path):
             metadata_files = filter(lambda f: '_metadata.json' in f, files)
             for metadata_file in metadata_files:
+                metadata_paths.append(os.path.join(root, metadata_file))
                 base_file = metadata_file.replace('_metadata.json', '')
-                metadata = self.prep_metadata(root=root, base_file=base_file)
-                self.prepare_file_location(metadata, root, base_file)
-                manifest.append(metadata)
+                with self.profile(os.path.join(root, base_file)):
+                    metadata = self.document_metadata(
+                        directory_path, root, base_file)
+                yield root, base_file, metadata
+        if self.catalog:
+            self.catalog.remove_missing(
+                self.agency_name(),
+                os.path.split(directory_path.rstrip('/'))[-1], metadata_paths)
+            self.catalog.commit()
+
+    def create_manifest(self, directory_path):
+        """ Generates a document manifest for a specific folder """
+
+        manifest = [
+            metadata for root, base_file, metadata
+            in self.collect_metadata(directory_path)]
 
         self.write_manifest(manifest=manifest, directory_path=directory_path)
         if self.s3_bucket:
             self.upload_folder_to_s3(
                 manifest=manifest, directory_path=directory_path)
 
-    def prepare_documents(self):
-        """ Looks for time-stamped directories inside an agency directory and
-        generates manifest files"""
+    def create_manifest_from_catalog(self, directory_path):
+        """ Generates a document manifest for a specific folder from the
+        catalog, without walking the folder """
+
+        manifest = self.catalog.manifest(
+            self.agency_name(), os.path.split(directory_path.rstrip('/'))[-1])
+        self.write_manifest(manifest=manifest, directory_path=directory_path)
+        if self.s3_bucket:
+            self.upload_folder_to_s3(
+                manifest=manifest, directory_path=directory_path)
+        return manifest
+
+    def time_stamped_directories(self):
+        """ Yields the paths of time-stamped directories inside the agency
+        directory """
 
         directory_files = os.listdir(self.agency_directory)
         for item in directory_files:
             if item.isdigit():
-                self.create_manifest(
-                    directory_path=os.path.join(self.agency_directory, item)
-                )
+                yield os.path.join(self.agency_directory, item)
+
+    def prepare_documents(self):
+        """ Looks for time-stamped directories inside an agency directory and
+        generates manifest files"""
+
+        for directory_path in self.time_stamped_directories():
+            self.create_manifest(directory_path=directory_path)
+        if self.profiler:
+            self.profiler.report()
@@ -30,9 +30,11 @@ class PrepareDocsS3(PrepareDocs):
                 lambda f: '_metadata.json' in f.name, files)
             for metadata_file in metadata_files:
                 base_file = metadata_file.name.replace('_metadata.json', '')
-                metadata = self.prep_metadata(root='', base_file=base_file)
-                self.prepare_file_location(
-                    metadata, root='', base_file=base_file)
+                with self.profile(base_file):
+                    metadata = self.prep_metadata(
+                        root='', base_file=base_file)
+                    self.prepare_file_location(
+                        metadata, root='', base_file=base_file)
                 manifest.append(metadata)
 
         # Write manifest
@@ -48,6 +50,8 @@ class PrepareDocsS3(PrepareDocs):
             location = item.name.replace(self.agency_directory, '').strip('/')
             if location.isdigit():
                 self.create_manifest(directory_path=item.name)
+        if self.profiler:
+            self.profiler.report()
 
 if __name__ == "__main__":
     preparer = PrepareDocsS3(
@@ -0,0 +1,301 @@
+from PrepareDocs import PrepareDocs
+from textextraction.extractors import text_extractor
+
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+import yaml
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+class PollingWatcher:
+    """ Reports files that appeared or changed in a directory tree by
+    comparing modification times and sizes between scans """
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        self.snapshot = self.scan()
+
+    def scan(self):
+        """ Returns the modification time and size of every file """
+
+        snapshot = {}
+        for root, dirs, files in os.walk(self.directory):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                snapshot[path] = (stat.st_mtime, stat.st_size)
+        return snapshot
+
+    def changes(self, timeout):
+        """ Waits `timeout` seconds and returns the paths that changed """
+
+        time.sleep(timeout)
+        snapshot = self.scan()
+        changed = [
+            path for path, stat in snapshot.items()
+            if self.snapshot.get(path) != stat]
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """ Reports files that were written or moved into a directory tree using
+    inotify. New directories are watched as they are created """
+
+    def __init__(self, directory):
+
+        self.inotify = INotify()
+        self.watches = {}
+        self.mask = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO
+        self.watch_tree(directory)
+
+    def watch_tree(self, directory):
+        """ Watches a directory and its subdirectories and returns the files
+        already inside them """
+
+        existing = []
+        for root, dirs, files in os.walk(directory):
+            self.watches[self.inotify.add_watch(root, self.mask)] = root
+            existing.extend(os.path.join(root, f) for f in files)
+        return existing
+
+    def changes(self, timeout):
+        """ Waits up to `timeout` seconds and returns the paths that were
+        written or moved in """
+
+        changed = []
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            path = os.path.join(self.watches.get(event.wd, ''), event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    changed.extend(self.watch_tree(path))
+            elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                changed.append(path)
+        return changed
+
+    def close(self):
+        self.inotify.close()
+
+
+def get_watcher(directory):
+    """ Returns an inotify watcher when inotify_simple is installed and a
+    polling watcher otherwise """
+
+    if INotify:
+        try:
+            return InotifyWatcher(directory)
+        except OSError:
+            logging.warning("inotify unavailable, polling %s", directory)
+    return PollingWatcher(directory)
+
+
+class WatchDocs(PrepareDocs):
+    """ WatchDocs watches an agency directory for new documents, extracts
+    them with a bounded pool of workers and adds them to the manifest of
+    their time-stamped directory as soon as they are extracted. With an s3
+    bucket, each document and the updated manifest are uploaded too.
+    Documents already waiting when watching starts are processed first """
+
+    # Files written by extraction and manifests, which are not documents
+    DERIVED_SUFFIXES = ('.txt', '_metadata.json', '.json', '.png',
+                        'manifest.yaml')
+
+    def __init__(self, agency_directory, custom_parser=None, s3_bucket=None,
+                 workers=4, debounce=1.0, poll_interval=0.5,
+                 extract=text_extractor, **options):
+        """
+        workers: number of documents extracted at the same time
+        debounce: seconds a file must stay unchanged before it is extracted
+        poll_interval: seconds between checks for new files
+        extract: function that extracts a document given its path
+        """
+        super().__init__(agency_directory, custom_parser, s3_bucket,
+                         **options)
+        self.workers = workers
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.extract = extract
+        self.pending = {}
+        self.manifests = {}
+        self.manifest_lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        self.stopped = threading.Event()
+
+    def date_directory(self, path):
+        """ Returns the time-stamped directory a path belongs to, if any """
+
+        parts = os.path.relpath(path, self.agency_directory).split(os.sep)
+        if len(parts) > 1 and parts[0].isdigit():
+            return os.path.join(self.agency_directory, parts[0])
+
+    def is_document(self, path):
+        """ Returns True for original documents inside a time-stamped
+        directory """
+
+        file_name = os.path.basename(path)
+        if file_name.startswith('.') or file_name.endswith(
+                self.DERIVED_SUFFIXES):
+            return False
+        return self.date_directory(path) is not None
+
+    def load_manifest(self, directory_path):
+        """ Returns the manifest entries of a directory keyed on document
+        location, reading manifest.yaml the first time """
+
+        if directory_path not in self.manifests:
+            manifest = []
+            manifest_file = os.path.join(directory_path, 'manifest.yaml')
+            if os.path.exists(manifest_file):
+                with open(manifest_file, 'r') as f:
+                    manifest = yaml.safe_load(f) or []
+            self.manifests[directory_path] = {
+                metadata['doc_location']: metadata for metadata in manifest}
+        return self.manifests[directory_path]
+
+    def write_manifest(self, manifest, directory_path):
+        """ Writes the manifest to a temporary file and renames it so readers
+        never see a partially written manifest """
+
+        temp_file = os.path.join(directory_path, '.manifest.yaml.tmp')
+        with open(temp_file, 'w') as f:
+            f.write(yaml.dump(
+                manifest,
+                default_flow_style=False, allow_unicode=True))
+        os.replace(temp_file, os.path.join(directory_path, 'manifest.yaml'))
+
+    def upload_document(self, directory_path, metadata):
+        """ Uploads the text and file of a document to s3 """
+
+        doc_root, doc_ext = os.path.splitext(metadata['doc_location'])
+        self.upload_doc_to_s3(
+            rel_doc_root=os.path.join(directory_path, doc_root),
+            upload_doc_loc=os.path.join(
+                self.upload_directory(directory_path), doc_root),
+            doc_ext=doc_ext)
+
+    def update_manifest(self, doc_path):
+        """ Adds or replaces the manifest entry of an extracted document and
+        publishes both to s3 when there is a bucket """
+
+        directory_path = self.date_directory(doc_path)
+        root, file_name = os.path.split(doc_path)
+        base_file = os.path.splitext(file_name)[0]
+        if not os.path.exists(
+                os.path.join(root, base_file + '_metadata.json')):
+            logging.warning("%s has no metadata, not in manifest", doc_path)
+            return
+        metadata = self.document_metadata(directory_path, root, base_file)
+        if self.s3_bucket:
+            # Before the manifest, so it never lists a missing document
+            self.upload_document(directory_path, metadata)
+        with self.manifest_lock:
+            entries = self.load_manifest(directory_path)
+            entries[metadata['doc_location']] = metadata
+            manifest = sorted(
+                entries.values(), key=lambda entry: entry['doc_location'])
+            self.write_manifest(
+                manifest=manifest, directory_path=directory_path)
+            if self.catalog:
+                self.catalog.commit()
+            if self.s3_bucket:
+                # Under the lock, so an older manifest never replaces a
+                # newer one in s3
+                self.upload_file_to_s3(
+                    rel_file_loc=os.path.join(
+                        directory_path, 'manifest.yaml'),
+                    upload_file_loc=os.path.join(
+                        self.upload_directory(directory_path),
+                        'manifest.yaml'))
+        logging.info("%s added to manifest", doc_path)
+
+    def unprocessed_documents(self):
+        """ Returns the documents already in time-stamped directories that
+        have no Tika metadata or no manifest entry, such as documents that
+        arrived while the watcher was not running """
+
+        documents = []
+        for root, dirs, files in os.walk(self.agency_directory):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                if not self.is_document(path):
+                    continue
+                base_file = os.path.splitext(file_name)[0]
+                if os.path.exists(
+                        os.path.join(root, base_file + '_metadata.json')):
+                    metadata = self.prep_metadata(root, base_file)
+                    self.prepare_file_location(metadata, root, base_file)
+                    with self.manifest_lock:
+                        entries = self.load_manifest(
+                            self.date_directory(path))
+                    if metadata['doc_location'] in entries:
+                        continue
+                documents.append(path)
+        return sorted(documents)
+
+    def process_document(self, doc_path):
+        """ Extracts a document and updates its manifest """
+
+        try:
+            self.extract(doc_path)
+            self.update_manifest(doc_path)
+        except Exception:
+            logging.exception("%s could not be processed", doc_path)
+        finally:
+            self.slots.release()
+
+    def ready_documents(self, now):
+        """ Returns pending documents that have not changed for `debounce`
+        seconds and removes them from pending """
+
+        ready = [
+            path for path, seen in self.pending.items()
+            if now - seen >= self.debounce]
+        for path in ready:
+            del self.pending[path]
+        return sorted(ready)
+
+    def run(self, watcher=None):
+        """ Watches the agency directory until stop() is called """
+
+        watcher = watcher or get_watcher(self.agency_directory)
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers)
+        try:
+            # Watchers only report changes, so catch up on earlier arrivals
+            now = time.monotonic()
+            for path in self.unprocessed_documents():
+                self.pending[path] = now
+            while not self.stopped.is_set():
+                changed = watcher.changes(self.poll_interval)
+                now = time.monotonic()
+                for path in changed:
+                    if self.is_document(path):
+                        self.pending[path] = now
+                for path in self.ready_documents(time.monotonic()):
+                    if not os.path.exists(path):
+                        continue
+                    # Blocks while the pool is busy so bursts queue here
+                    self.slots.acquire()
+                    executor.submit(self.process_document, path)
+        finally:
+            executor.shutdown(wait=True)
+            watcher.close()
+
+    def stop(self):
+        """ Stops run() after the current poll """
+
+        self.stopped.set()
@@ -3,11 +3,23 @@ from unittest import TestCase, main
 
 import os
 import boto
+import boto.s3.connection
+import hashlib
 import moto
 import json
 import yaml
+import shutil
+import tempfile
+import PackDocs
 import PrepareDocs
 import PrepareDocsS3
+import threading
+import time
+import WatchDocs
+
+from textextraction.catalog import MetadataCatalog
+from textextraction.duplicates import NearDuplicateIndex
+from textextraction.profiling import DocumentProfiler
 
 LOCAL_PATH = os.path.dirname(os.path.realpath(__file__))
 
@@ -68,6 +80,58 @@ class TestPrepareDocs(TestCase):
             metadata_file=metadata_file_loc)
         self.assertEqual(expected_metadata, metadata)
 
+    def test_normalize_tika_metadata(self):
+        """ Test that batch normalization returns columns that match
+        normalizing each record, including lists, missing keys and raw
+        JSON """
+
+        metadata_file = os.path.join(
+            LOCAL_PATH, 'fixtures/national-archives-and-records-'
+            'administration/20150331/090004d2805baaa4/record_metadata.json')
+        with open(metadata_file, 'rb') as f:
+            raw = f.read()
+        records = [
+            raw,
+            json.loads(raw.decode('utf-8')),
+            {'dc:format': ['application/msword', 'text/plain'],
+             'title': ['Memo', 'Alternate'],
+             'Last-Save-Date': ['2013-03-20T17:11:17Z']},
+            {'dc:format': [], 'title': []},
+            {},
+            b'not json',
+        ]
+        columns = self._connection.normalize_tika_metadata(records)
+        self.assertEqual(set(columns), set(expected_metadata))
+        self.assertEqual(
+            [dict(zip(columns, row)) for row in zip(*columns.values())],
+            [self._connection.normalize_record(
+                self._connection.load_tika_metadata(record)
+                if isinstance(record, bytes) else record)
+             for record in records])
+        self.assertEqual(columns['file_type'],
+                         ['pdf', 'pdf', 'msword', '', '', ''])
+        self.assertEqual(columns['title'][2], 'Memo')
+        self.assertEqual(columns['date_released'][2], '2013-03-20')
+        self.assertEqual(columns['pages'][0], expected_metadata['pages'])
+
+    def test_profiler(self):
+        """ Test that each document's metadata is profiled """
+
+        with tempfile.TemporaryDirectory() as temp:
+            profiler = DocumentProfiler(temp, threshold=0)
+            prep = PrepareDocs.PrepareDocs(
+                self._connection.agency_directory, profiler=profiler)
+            directory_path = os.path.join(
+                self._connection.agency_directory, '20150331')
+            documents = list(prep.collect_metadata(directory_path))
+            ranked = profiler.report()
+            self.assertEqual(len(ranked), len(documents))
+            self.assertEqual(
+                sorted(record['doc_id'] for record in ranked),
+                sorted(os.path.join(root, base_file)
+                       for root, base_file, metadata in documents))
+            self.assertTrue(os.path.exists(ranked[0]['profile']))
+
     def test_prep_metadata(self):
         """ Verify that data are extracted without custom parser
         and data are correctly merged with custom parser """
@@ -130,6 +194,109 @@ class TestPrepareDocs(TestCase):
         self.assertTrue('090004d2805baaa4' in manifest)
         os.remove(manifest_file)
 
+    def test_flag_near_duplicate(self):
+        """ Check that a copy of a document is flagged in the manifest """
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(
+                self._connection.agency_directory, '20150331',
+                '090004d2805baaa4')
+            date_dir = os.path.join(temp_dir, 'agency', '20150331')
+            shutil.copytree(source, os.path.join(date_dir, 'a'))
+            shutil.copytree(source, os.path.join(date_dir, 'b'))
+            preparer = PrepareDocs.PrepareDocs(
+                os.path.join(temp_dir, 'agency'),
+                duplicate_index=NearDuplicateIndex())
+            preparer.prepare_documents()
+            with open(os.path.join(date_dir, 'manifest.yaml')) as f:
+                manifest = yaml.load(f, Loader=yaml.SafeLoader)
+        flags = [doc.get('near_duplicate_of') for doc in manifest]
+        self.assertEqual(flags.count(None), 1)
+        flags.remove(None)
+        self.assertIn(flags[0], [
+            'agency/20150331/a/record', 'agency/20150331/b/record'])
+
+    def test_create_manifest_from_catalog(self):
+        """ Check that the catalog caches metadata and rebuilds the same
+        manifest without walking the directory """
+
+        catalog = MetadataCatalog()
+        preparer = PrepareDocs.PrepareDocs(
+            self._connection.agency_directory,
+            custom_parser=parse_foiaonline_metadata, catalog=catalog)
+        preparer.prepare_documents()
+        manifest_file = os.path.join(
+            preparer.agency_directory, '20150331', 'manifest.yaml')
+        with open(manifest_file, 'r') as f:
+            walked = yaml.load(f, Loader=yaml.SafeLoader)
+
+        # Unchanged metadata comes from the catalog, not the parsers
+        def failing_parser(metadata_file, tika_metadata):
+            raise AssertionError('metadata was parsed again')
+
+        preparer.custom_parser = failing_parser
+        root = os.path.join(
+            preparer.agency_directory, '20150331', '090004d2805baaa4')
+        metadata = preparer.prep_metadata(root=root, base_file='record')
+        self.assertEqual(metadata['title'], 'FY2006-12')
+
+        manifest = preparer.create_manifest_from_catalog(
+            os.path.join(preparer.agency_directory, '20150331'))
+        os.remove(manifest_file)
+        self.assertEqual(
+            sorted(manifest, key=lambda doc: doc['doc_location']),
+            sorted(walked, key=lambda doc: doc['doc_location']))
+        self.assertEqual(len(catalog.query(
+            agency='national-archives-and-records-administration',
+            file_type='pdf')), 2)
+
+    def test_catalog_drops_removed_documents(self):
+        """ Check that documents removed from disk are dropped from the
+        catalog when the directory is walked again """
+
+        catalog = MetadataCatalog()
+        preparer = PrepareDocs.PrepareDocs(
+            self._connection.agency_directory,
+            custom_parser=parse_foiaonline_metadata, catalog=catalog)
+        date_dir = os.path.join(preparer.agency_directory, '20150331')
+        preparer.create_manifest(date_dir)
+        rebuilt = preparer.create_manifest_from_catalog(date_dir)
+        removed = rebuilt[0]['doc_location']
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            document = os.path.join(date_dir, os.path.dirname(removed))
+            shutil.move(document, temp_dir)
+            try:
+                preparer.create_manifest(date_dir)
+                rebuilt = preparer.create_manifest_from_catalog(date_dir)
+            finally:
+                shutil.move(
+                    os.path.join(temp_dir, os.path.basename(document)),
+                    date_dir)
+        os.remove(os.path.join(date_dir, 'manifest.yaml'))
+        self.assertNotIn(removed, [doc['doc_location'] for doc in rebuilt])
+        self.assertTrue(rebuilt)
+
+    def test_raw_metadata_from_catalog(self):
+        """ Check that raw Tika metadata in the catalog is only used while
+        the metadata file is unchanged """
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            metadata_file = os.path.join(temp_dir, 'record_metadata.json')
+            with open(metadata_file, 'w') as f:
+                f.write('{"title": "new"}')
+            catalog = MetadataCatalog()
+            preparer = PrepareDocs.PrepareDocs(temp_dir, catalog=catalog)
+            mtime = os.path.getmtime(metadata_file)
+
+            catalog.record_raw(metadata_file, '{"title": "old"}', mtime - 1)
+            self.assertEqual(
+                preparer.parse_tika_metadata(metadata_file)['title'], 'new')
+            catalog.record_raw(metadata_file, '{"title": "cached"}', mtime)
+            self.assertEqual(
+                preparer.parse_tika_metadata(metadata_file)['title'],
+                'cached')
+
 
 class TestPrepareDocsWithS3(TestCase):
 
@@ -140,6 +307,8 @@ class TestPrepareDocsWithS3(TestCase):
             'fixtures/national-archives-and-records-administration')
         )
         cls._connection.custom_parser = parse_foiaonline_metadata
+        # moto's mocked sockets cannot be shared between upload threads
+        cls._connection.upload_workers = 1
 
     @moto.mock_s3
     def test_upload_one_file_to_s3(self):
@@ -189,6 +358,109 @@ class TestPrepareDocsWithS3(TestCase):
             self._connection.agency_directory, '20150331', 'manifest.yaml')
         os.remove(manifest_file)
 
+    def test_local_etag(self):
+        """ Verify that local ETags match the s3 format for single and
+        multipart uploads """
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_loc = os.path.join(temp_dir, 'record.pdf')
+            with open(file_loc, 'wb') as f:
+                f.write(b'0123456789abcdefghij')
+            preparer = PrepareDocs.PrepareDocs(temp_dir)
+            self.assertEqual(
+                preparer.local_etag(file_loc),
+                hashlib.md5(b'0123456789abcdefghij').hexdigest())
+
+            preparer.MULTIPART_THRESHOLD = 10
+            preparer.MULTIPART_CHUNK = 8
+            parts = [b'01234567', b'89abcdef', b'ghij']
+            expected = hashlib.md5(b''.join(
+                hashlib.md5(part).digest() for part in parts)).hexdigest()
+            self.assertEqual(preparer.local_etag(file_loc), expected + '-3')
+
+    def test_upload_bucket(self):
+        """ Verify that upload threads open connections with the same
+        credentials and proxy as the main connection """
+
+        conn = boto.s3.connection.S3Connection(
+            aws_access_key_id='key', aws_secret_access_key='secret',
+            security_token='token', proxy='proxy.example', proxy_port=3128)
+        preparer = PrepareDocs.PrepareDocs(LOCAL_PATH)
+        preparer.s3_bucket = conn.get_bucket('testbucket', validate=False)
+        self.assertIs(preparer.upload_bucket(), preparer.s3_bucket)
+
+        buckets = []
+        thread = threading.Thread(
+            target=lambda: buckets.append(preparer.upload_bucket()))
+        thread.start()
+        thread.join()
+        thread_conn = buckets[0].connection
+        self.assertIsNot(thread_conn, conn)
+        self.assertEqual(thread_conn.provider.security_token, 'token')
+        self.assertEqual(thread_conn.aws_access_key_id, 'key')
+        self.assertEqual(thread_conn.proxy, 'proxy.example')
+        self.assertEqual(thread_conn.proxy_port, 3128)
+        self.assertEqual(buckets[0].name, 'testbucket')
+
+    def test_upload_folder_concurrently(self):
+        """ Verify that every document is uploaded when uploads run in a
+        pool of threads """
+
+        preparer = PrepareDocs.PrepareDocs(
+            self._connection.agency_directory, s3_sync=False,
+            upload_workers=4)
+        uploads = []
+        threads = set()
+
+        def upload_file_to_s3(rel_file_loc, upload_file_loc):
+            uploads.append(upload_file_loc)
+            threads.add(threading.current_thread().name)
+            time.sleep(0.01)
+            return True
+
+        preparer.upload_file_to_s3 = upload_file_to_s3
+        directory_path = os.path.join(
+            self._connection.agency_directory, '20150331')
+        manifest = [metadata for root, base_file, metadata
+                    in preparer.collect_metadata(directory_path)]
+        preparer.upload_folder_to_s3(manifest, directory_path)
+
+        upload_dir = 'national-archives-and-records-administration/20150331'
+        expected = [os.path.join(upload_dir, 'manifest.yaml')]
+        for metadata in manifest:
+            doc_root, doc_ext = os.path.splitext(metadata['doc_location'])
+            expected.append(os.path.join(upload_dir, doc_root + '.txt'))
+            expected.append(os.path.join(upload_dir, doc_root + doc_ext))
+        self.assertEqual(sorted(uploads), sorted(expected))
+        self.assertGreater(len(threads), 1)
+
+    @moto.mock_s3
+    def test_sync_skips_unchanged_files(self):
+        """ Verify that files already in s3 are not uploaded again """
+
+        conn = boto.connect_s3()
+        conn.create_bucket('testbucket')
+        self._connection.s3_bucket = conn.get_bucket('testbucket')
+        self._connection.prepare_documents()
+
+        upload_dir = 'national-archives-and-records-administration/20150331'
+        doc_root = '090004d2805baaa4/record'
+        rel_doc_root = os.path.join(
+            self._connection.agency_directory, '20150331', doc_root)
+        self._connection.remote_files = self._connection.list_remote_files(
+            upload_dir + '/')
+        self.assertFalse(self._connection.upload_file_to_s3(
+            rel_file_loc=rel_doc_root + '.pdf',
+            upload_file_loc=os.path.join(upload_dir, doc_root + '.pdf')))
+        self.assertTrue(self._connection.upload_file_to_s3(
+            rel_file_loc=rel_doc_root + '.txt',
+            upload_file_loc=os.path.join(upload_dir, doc_root + '.pdf')))
+        self._connection.remote_files = None
+
+        manifest_file = os.path.join(
+            self._connection.agency_directory, '20150331', 'manifest.yaml')
+        os.remove(manifest_file)
+
 
 class TestPrepareDocsS3(TestCase):
     """ Test that PrepareDocsS3 works generates manifest entirely on S3 """
@@ -234,5 +506,209 @@ class TestPrepareDocsS3(TestCase):
         self.assertEqual(len(manifest), 3)
 
 
+class TestPackDocs(TestCase):
+    """ Test that PackDocs writes text and metadata into shards """
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def pack(self, codec):
+        """ Packs the fixtures and returns a reader for the dated folder """
+
+        packer = PackDocs.PackDocs(
+            os.path.join(
+                LOCAL_PATH,
+                'fixtures/national-archives-and-records-administration'),
+            output_directory=self.temp.name, codec=codec, block_size=2)
+        packer.prepare_documents()
+        return PackDocs.ShardReader(os.path.join(
+            self.temp.name, 'national-archives-and-records-administration',
+            '20150331'))
+
+    def test_get(self):
+        """ Check that a single document can be read back by id """
+
+        reader = self.pack(codec='gzip')
+        record = reader.get('090004d2805baaa4/record')
+        self.assertEqual(record['pages'], expected_metadata['pages'])
+        self.assertEqual(
+            record['doc_location'], '090004d2805baaa4/record.pdf')
+        self.assertIn('FOIA Requests Filed', record['text'])
+
+    def test_iter(self):
+        """ Check that streaming the shards yields every document """
+
+        reader = self.pack(codec='gzip')
+        self.assertEqual(len(reader.index['blocks']), 2)
+        ids = sorted(record['id'] for record in reader)
+        self.assertEqual(ids, sorted(reader.index['documents']))
+        self.assertEqual(ids, [
+            '090004d280039e4a/record', '090004d2804eb1ab/record',
+            '090004d2805baaa4/record'])
+
+    def test_create_manifest_is_not_overridden(self):
+        """ Check that packing leaves the manifest hook alone, so
+        create_manifest still writes a manifest and no shards """
+
+        fixtures = os.path.join(
+            LOCAL_PATH,
+            'fixtures/national-archives-and-records-administration')
+        packer = PackDocs.PackDocs(fixtures, output_directory=self.temp.name)
+        date_dir = os.path.join(fixtures, '20150331')
+        packer.create_manifest(date_dir)
+        manifest_file = os.path.join(date_dir, 'manifest.yaml')
+        with open(manifest_file, 'r') as f:
+            manifest = yaml.load(f, Loader=yaml.SafeLoader)
+        os.remove(manifest_file)
+        self.assertEqual(len(manifest), 3)
+        self.assertEqual(os.listdir(self.temp.name), [])
+
+    def test_id_with_dotted_file_type(self):
+        """ Check that ids do not depend on the document's file type """
+
+        agency = os.path.join(self.temp.name, 'agency')
+        shutil.copytree(
+            os.path.join(
+                LOCAL_PATH,
+                'fixtures/national-archives-and-records-administration'),
+            agency)
+        metadata_file = os.path.join(
+            agency, '20150331', '090004d2804eb1ab', 'record_metadata.json')
+        with open(metadata_file) as f:
+            tika_metadata = json.load(f)
+        tika_metadata['dc:format'] = 'application/vnd.ms-excel'
+        with open(metadata_file, 'w') as f:
+            json.dump(tika_metadata, f)
+
+        output = os.path.join(self.temp.name, 'output')
+        PackDocs.PackDocs(agency, output_directory=output).prepare_documents()
+        reader = PackDocs.ShardReader(
+            os.path.join(output, 'agency', '20150331'))
+        record = reader.get('090004d2804eb1ab/record')
+        self.assertEqual(
+            record['doc_location'], '090004d2804eb1ab/record.vnd.ms-excel')
+
+    def test_shard_rotation(self):
+        """ Check that blocks spill into new shards past shard_bytes """
+
+        with PackDocs.ShardWriter(
+                self.temp.name, codec=PackDocs.GzipCodec(), block_size=1,
+                shard_bytes=1) as writer:
+            for i in range(3):
+                writer.write(str(i), {'text': 'record %d' % i})
+        reader = PackDocs.ShardReader(self.temp.name)
+        self.assertEqual(len(reader.index['shards']), 3)
+        self.assertEqual(reader.get('2'), {'text': 'record 2'})
+
+
+class TestWatchDocs(TestCase):
+    """ Test that WatchDocs extracts new documents and updates manifests """
+
+    fixture = os.path.join(
+        LOCAL_PATH, 'fixtures', 'national-archives-and-records-administration',
+        '20150331', '090004d2805baaa4')
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.agency = os.path.join(self.temp.name, 'agency')
+        os.makedirs(os.path.join(self.agency, '20150331'))
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def fake_extract(self, doc_path):
+        """ Stands in for Tika by copying the fixture's metadata """
+
+        shutil.copyfile(
+            os.path.join(self.fixture, 'record_metadata.json'),
+            os.path.splitext(doc_path)[0] + '_metadata.json')
+
+    def test_is_document(self):
+        """ Check that only originals in dated directories are extracted """
+
+        watcher = WatchDocs.WatchDocs(self.agency)
+        date_dir = os.path.join(self.agency, '20150331', 'a')
+        self.assertTrue(watcher.is_document(
+            os.path.join(date_dir, 'record.pdf')))
+        self.assertFalse(watcher.is_document(
+            os.path.join(date_dir, 'record_metadata.json')))
+        self.assertFalse(watcher.is_document(
+            os.path.join(date_dir, 'record.txt')))
+        self.assertFalse(watcher.is_document(
+            os.path.join(self.agency, 'record.pdf')))
+
+    def test_unprocessed_documents(self):
+        """ Check that documents without metadata or a manifest entry are
+        found when watching starts """
+
+        date_dir = os.path.join(self.agency, '20150331')
+        shutil.copytree(self.fixture, os.path.join(date_dir, 'new'),
+                        ignore=shutil.ignore_patterns('*.json'))
+        for name in ('listed', 'unlisted'):
+            shutil.copytree(self.fixture, os.path.join(date_dir, name))
+        with open(os.path.join(date_dir, 'manifest.yaml'), 'w') as f:
+            f.write(yaml.dump([{'doc_location': 'listed/record.pdf'}]))
+
+        watcher = WatchDocs.WatchDocs(self.agency)
+        self.assertEqual(watcher.unprocessed_documents(), [
+            os.path.join(date_dir, 'new', 'record.pdf'),
+            os.path.join(date_dir, 'unlisted', 'record.pdf')])
+
+    @moto.mock_s3
+    def test_update_manifest_uploads_to_s3(self):
+        """ Check that watched documents and their manifest reach s3 """
+
+        conn = boto.connect_s3()
+        conn.create_bucket('testbucket')
+        date_dir = os.path.join(self.agency, '20150331')
+        shutil.copytree(self.fixture, os.path.join(date_dir, 'a'))
+        watcher = WatchDocs.WatchDocs(self.agency, s3_bucket='testbucket')
+        watcher.update_manifest(os.path.join(date_dir, 'a', 'record.pdf'))
+        self.assertEqual(
+            sorted(key.name for key in conn.get_bucket('testbucket').list()),
+            ['agency/20150331/a/record.pdf', 'agency/20150331/a/record.txt',
+             'agency/20150331/manifest.yaml'])
+
+    def test_run(self):
+        """ Check that documents waiting when watching starts and documents
+        arriving while watching end up in the manifest next to the existing
+        entries """
+
+        date_dir = os.path.join(self.agency, '20150331')
+        with open(os.path.join(date_dir, 'manifest.yaml'), 'w') as f:
+            f.write(yaml.dump([{'doc_location': 'old/record.pdf'}]))
+        shutil.copytree(self.fixture, os.path.join(date_dir, 'early'),
+                        ignore=shutil.ignore_patterns('*.json'))
+        watcher = WatchDocs.WatchDocs(
+            self.agency, workers=2, debounce=0.1, poll_interval=0.05,
+            extract=self.fake_extract)
+        thread = threading.Thread(
+            target=watcher.run,
+            args=(WatchDocs.PollingWatcher(self.agency),))
+        thread.start()
+        try:
+            for name in ('a', 'b'):
+                shutil.copytree(self.fixture, os.path.join(date_dir, name),
+                                ignore=shutil.ignore_patterns('*.json'))
+            manifest = []
+            for i in range(100):
+                time.sleep(0.05)
+                with open(os.path.join(date_dir, 'manifest.yaml')) as f:
+                    manifest = yaml.safe_load(f)
+                if len(manifest) == 4:
+                    break
+        finally:
+            watcher.stop()
+            thread.join()
+        self.assertEqual(
+            [doc['doc_location'] for doc in manifest],
+            ['a/record.pdf', 'b/record.pdf', 'early/record.pdf',
+             'old/record.pdf'])
+        self.assertEqual(manifest[0]['pages'], expected_metadata['pages'])
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,103 @@
+"""
+Compares normalizing Tika metadata one record at a time with the batch
+PrepareDocs.normalize_tika_metadata on synthetic records. Both paths parse
+with PrepareDocs.load_tika_metadata, so they use the same JSON parser, and
+are timed on already parsed dicts and on raw JSON separately.
+
+Usage: python benchmarks/bench_normalize.py [records] [repeats]
+"""
+
+import json
+import os
+import random
+import sys
+import time
+
+LOCAL_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(LOCAL_PATH, '..', 'DocPrepare'))
+
+from PrepareDocs import PrepareDocs, orjson  # noqa: E402
+
+FILE_TYPES = [
+    'application/pdf', 'application/msword',
+    'application/vnd.ms-excel', 'text/plain; charset=ISO-8859-1',
+    ['application/pdf', 'application/pdf; version=1.4']]
+
+
+def make_records(count, seed=0):
+    """ Returns raw Tika JSON records with scalar, list and missing fields
+    """
+
+    rng = random.Random(seed)
+    records = []
+    for i in range(count):
+        record = {
+            'dc:format': rng.choice(FILE_TYPES),
+            'Content-Type': 'application/pdf',
+            'X-Parsed-By': ['org.apache.tika.parser.DefaultParser'],
+        }
+        if rng.random() < 0.9:
+            record['Last-Save-Date'] = '2013-03-%02dT17:11:17Z' % (i % 28 + 1)
+        if rng.random() < 0.8:
+            record['meta:creation-date'] = '2012-01-01T00:00:00Z'
+        if rng.random() < 0.7:
+            record['title'] = 'Record %d' % i
+        if rng.random() < 0.2:
+            record['title'] = ['Record %d' % i, 'Alternate title']
+        record['xmpTPg:NPages'] = str(rng.randint(1, 500))
+        records.append(json.dumps(record).encode('utf-8'))
+    return records
+
+
+def per_record(prep, records):
+    """ The per-record path: parse and normalize each record on its own """
+
+    return [
+        prep.normalize_record(
+            record if isinstance(record, dict)
+            else prep.load_tika_metadata(record))
+        for record in records]
+
+
+def best_of(function, repeats):
+    """ Returns the fastest of `repeats` runs in seconds """
+
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def compare(prep, label, records, repeats):
+    """ Times both paths on the same records and prints the results """
+
+    count = len(records)
+    single = best_of(lambda: per_record(prep, records), repeats)
+    batch = best_of(
+        lambda: prep.normalize_tika_metadata(records), repeats)
+    print('%s input' % label)
+    print('  per record %.3f s (%.2f us/record)' % (
+        single, single / count * 1e6))
+    print('  batch      %.3f s (%.2f us/record), %.2fx' % (
+        batch, batch / count * 1e6, single / batch))
+
+
+def main(count=200000, repeats=3):
+    prep = PrepareDocs('agency')
+    records = make_records(count)
+    parsed = [prep.load_tika_metadata(raw) for raw in records]
+    rows = per_record(prep, records)
+    columns = prep.normalize_tika_metadata(records)
+    assert all(columns[field] == [row[field] for row in rows]
+               for field, key in prep.TIKA_FIELDS)
+
+    print('%d records, json parser %s' % (
+        count, 'orjson' if orjson else 'json'))
+    compare(prep, 'dict', parsed, repeats)
+    compare(prep, 'raw JSON', records, repeats)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
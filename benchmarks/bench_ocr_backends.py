@@ -0,0 +1,64 @@
+"""
+Compares the OCR backends on the fixture PDFs. Pages are rendered once with
+Ghostscript and then OCRed by each available backend.
+
+Usage: python benchmarks/bench_ocr_backends.py [repeats]
+"""
+
+import glob
+import os
+import sys
+import tempfile
+import time
+
+from textextraction.extractors import (OCR_BACKENDS, PDFTextExtraction,
+                                       TesseractCLI)
+
+LOCAL_PATH = os.path.dirname(os.path.realpath(__file__))
+FIXTURES = os.path.join(LOCAL_PATH, '..', 'tests', 'fixtures')
+
+
+def render_pages(temp_dir):
+    """ Renders every fixture PDF to png pages in scratch space inside
+    temp_dir. Returns the extractors, which own the scratch space and must
+    be kept until timing is done, and the pages """
+
+    extractors = []
+    pages = []
+    for pdf in sorted(glob.glob(os.path.join(FIXTURES, '*.pdf'))):
+        extractor = PDFTextExtraction(
+            pdf, ocr_backend=TesseractCLI(), scratch_dir=temp_dir)
+        extractor.pdf_to_img()
+        extractors.append(extractor)
+        pages.extend(glob.glob(extractor.page_root() + '_*.png'))
+    return extractors, sorted(pages)
+
+
+def time_backend(backend, pages, repeats):
+    """ Returns the mean seconds per page for a backend """
+
+    start = time.perf_counter()
+    for i in range(repeats):
+        for png in pages:
+            backend.ocr(png, png[:-4])
+    return (time.perf_counter() - start) / (repeats * len(pages))
+
+
+def main(repeats=3):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        extractors, pages = render_pages(temp_dir)
+        print('%d pages, %d repeats' % (len(pages), repeats))
+        for name, backend_class in sorted(OCR_BACKENDS.items()):
+            try:
+                backend = backend_class()
+            except ImportError:
+                print('%-4s unavailable' % name)
+                continue
+            per_page = time_backend(backend, pages, repeats)
+            print('%-4s %.3f s/page' % (name, per_page))
+        for extractor in extractors:
+            extractor.cleanup()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,63 @@
+"""
+Measures cold start time of `text_extractor` for short lived workers: the
+time to import textextraction.extractors in a fresh interpreter and the
+time to set up an extractor.
+
+Usage: python benchmarks/bench_startup.py [--max-ms N] [repeats]
+Exits with status 1 if the median cold import is slower than --max-ms.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+LOCAL_PATH = os.path.dirname(os.path.realpath(__file__))
+REPO_PATH = os.path.join(LOCAL_PATH, '..')
+
+COLD_IMPORT = """
+import time
+start = time.perf_counter()
+import textextraction.extractors
+print(time.perf_counter() - start)
+"""
+
+
+def cold_import_seconds():
+    """ Returns the import time of the extractors module in a new process """
+
+    output = subprocess.check_output(
+        [sys.executable, '-c', COLD_IMPORT], cwd=REPO_PATH)
+    return float(output)
+
+
+def setup_seconds(repeats=1000):
+    """ Returns the mean time to create a PDFTextExtraction """
+
+    sys.path.insert(0, REPO_PATH)
+    from textextraction.extractors import PDFTextExtraction
+    start = time.perf_counter()
+    for i in range(repeats):
+        PDFTextExtraction('record.pdf')
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('repeats', type=int, nargs='?', default=10)
+    parser.add_argument('--max-ms', type=float)
+    args = parser.parse_args()
+
+    cold = statistics.median(
+        cold_import_seconds() for i in range(args.repeats)) * 1000
+    print('cold import %.1f ms' % cold)
+    print('extractor setup %.1f us' % (setup_seconds() * 1e6))
+    if args.max_ms and cold > args.max_ms:
+        print('cold import slower than %.1f ms' % args.max_ms)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,33 @@
 import os
+import sys
 import moto
 import boto
+import tempfile
+import shutil
+import subprocess
+import json
+import threading
+import time
 
 from boto.s3.key import Key
-from unittest import TestCase, main
+from unittest import TestCase, main, mock
 from textextraction.extractors import (TextExtraction, PDFTextExtraction,
                                        TextExtractionS3, PDFTextExtractionS3,
-                                       text_extractor, text_extractor_s3)
+                                       OCRCache, OCRSettings, ScratchSpace,
+                                       ScratchSpaceExceeded, TesseractCLI,
+                                       TesseractAPI, TikaError,
+                                       DocumentNotFound,
+                                       get_ocr_backend, get_ocr_pool,
+                                       get_tika_limiter, has_tesserocr,
+                                       run_extractor, text_extractor,
+                                       text_extractor_s3)
+from textextraction.limiter import AdaptiveLimiter, backoff_delay
+from textextraction.profiling import DocumentProfiler
+from textextraction.limits import (LimitExceeded, Quarantine, ResourceLimits,
+                                   communicate)
+from textextraction.duplicates import (MAX_SHINGLES, NearDuplicateIndex,
+                                       minhash, shingles, similarity)
+from textextraction.catalog import MetadataCatalog
 
 LOCAL_PATH = os.path.dirname(os.path.realpath(__file__))
 
@@ -129,9 +150,11 @@ class TestPDFTextExtraction(TestCase):
         extractor = PDFTextExtraction(
             doc_path=os.path.join(LOCAL_PATH, 'fixtures/record_no_text.pdf'))
         extractor.pdf_to_img()
+        self.assertTrue(os.path.isfile(extractor.page_root() + '_001.png'))
         extractor.img_to_text()
         self.assertTrue(os.path.isfile(
             os.path.join(LOCAL_PATH, 'fixtures/record_no_text.pdf')))
+        extractor.cleanup()
 
     def test_extract(self):
         """
@@ -157,11 +180,804 @@ class TestPDFTextExtraction(TestCase):
 
         self.assertTrue(os.path.isfile(
             os.path.join(LOCAL_PATH, 'fixtures/record_no_text.txt')))
-        self.assertTrue(os.path.isfile(
+        self.assertFalse(os.path.isfile(
             os.path.join(LOCAL_PATH, 'fixtures/record_no_text_001.png')))
         self.assertTrue(os.path.isfile(os.path.join(
             LOCAL_PATH, 'fixtures/record_no_text_metadata.json')))
 
+    def test_extract_uses_scratch_dir(self):
+        """
+        Check that page images are written to the scratch directory and
+        removed after extraction
+        """
+        with tempfile.TemporaryDirectory() as scratch_dir:
+            extractor = PDFTextExtraction(
+                doc_path=os.path.join(
+                    LOCAL_PATH, 'fixtures/record_no_text.pdf'),
+                scratch_dir=scratch_dir)
+            extractor.pdf_to_img()
+            self.assertTrue(
+                extractor.page_root().startswith(scratch_dir))
+            self.assertTrue(os.listdir(scratch_dir))
+            extractor.extract()
+            self.assertEqual(os.listdir(scratch_dir), [])
+
+
+class TestStartup(TestCase):
+
+    def test_local_import_skips_s3(self):
+        """ Check that importing the extractors does not load boto """
+
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, textextraction.extractors; '
+            'print("boto" in sys.modules)'],
+            cwd=os.path.join(LOCAL_PATH, '..'))
+        self.assertEqual(output.strip(), b'False')
+
+    def test_words_pattern_is_shared(self):
+        """ Check that extractors reuse the module level word pattern """
+
+        first = PDFTextExtraction(doc_path='first.pdf')
+        second = PDFTextExtraction(doc_path='second.pdf')
+        self.assertIs(first.WORDS, second.WORDS)
+
+
+class TestOCRBackends(TestCase):
+
+    def tearDown(self):
+        """
+        Removes file created during the test
+        """
+        delete_files()
+
+    def test_get_ocr_backend(self):
+        """ Check that backends are selected by name and that auto uses
+        tesserocr when it is installed and falls back to the command line
+        otherwise """
+
+        self.assertIsInstance(get_ocr_backend('cli'), TesseractCLI)
+        self.assertEqual(get_ocr_backend('cli', 'fra').settings(),
+                         ['-l', 'fra'])
+
+        self.addCleanup(has_tesserocr.cache_clear)
+        has_tesserocr.cache_clear()
+        with mock.patch('importlib.util.find_spec', return_value=None):
+            self.assertIs(type(get_ocr_backend('auto')), TesseractCLI)
+        has_tesserocr.cache_clear()
+        with mock.patch('importlib.util.find_spec', return_value=object()), \
+                mock.patch.dict(sys.modules, {'tesserocr': object()}):
+            self.assertIs(type(get_ocr_backend('auto')), TesseractAPI)
+
+    def test_backends_produce_text(self):
+        """ Check that every available backend OCRs the same page """
+
+        extractor = PDFTextExtraction(
+            doc_path=os.path.join(LOCAL_PATH, 'fixtures/record_no_text.pdf'))
+        extractor.pdf_to_img()
+        out_file = extractor.page_root()
+        for backend_class in (TesseractCLI, TesseractAPI):
+            try:
+                backend = backend_class()
+            except ImportError:
+                continue
+            backend.ocr(out_file + '_001.png', out_file)
+            with open(out_file + '.txt') as f:
+                self.assertTrue(f.read().strip())
+        extractor.cleanup()
+
+
+class FakeOCR(TesseractCLI):
+    """ Writes the page name and languages instead of running Tesseract """
+
+    def __init__(self, script=None, **kwargs):
+        super().__init__(**kwargs)
+        self.script = script
+        self.detected = 0
+
+    def ocr(self, png, out_file, timeout=None, ocr_settings=None):
+        ocr_settings = ocr_settings or self.ocr_settings
+        with open(out_file + '.txt', 'w') as f:
+            f.write('%s %s\n' % (
+                os.path.basename(out_file), ocr_settings.language))
+
+    def detect_script(self, png, timeout=None):
+        self.detected += 1
+        return self.script
+
+
+class TestOCRSettings(TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def extractor(self, pages=3, **kwargs):
+        """ Returns an extractor with blank rendered pages in scratch """
+
+        extractor = PDFTextExtraction(
+            os.path.join(self.temp.name, 'doc.pdf'), **kwargs)
+        for page in range(1, pages + 1):
+            with open(extractor.page_root() + '_%03d.png' % page, 'w') as f:
+                f.write(str(page))
+        return extractor
+
+    def test_args(self):
+        """ Check that settings become tesseract options """
+
+        self.assertEqual(OCRSettings().args(), ['-l', 'eng'])
+        ocr_settings = OCRSettings(
+            'eng+spa', psm=6, oem=1, whitelist='0123456789')
+        self.assertEqual(ocr_settings.languages, ['eng', 'spa'])
+        self.assertEqual(ocr_settings.args(), [
+            '-l', 'eng+spa', '--psm', '6', '--oem', '1',
+            '-c', 'tessedit_char_whitelist=0123456789'])
+        backend = get_ocr_backend('cli', ocr_settings=ocr_settings)
+        self.assertEqual(backend.settings(), ocr_settings.args())
+        self.assertEqual(backend.settings(OCRSettings(['fra'])),
+                         ['-l', 'fra'])
+
+    def test_for_script(self):
+        """ Check that detected scripts replace the languages only when
+        they have languages of their own """
+
+        ocr_settings = OCRSettings(['eng', 'spa'], psm=4)
+        cyrillic = ocr_settings.for_script('Cyrillic')
+        self.assertEqual(cyrillic.args(), ['-l', 'rus', '--psm', '4'])
+        self.assertIs(ocr_settings.for_script('Latin'), ocr_settings)
+        self.assertIs(ocr_settings.for_script(None), ocr_settings)
+
+    def test_detect_script(self):
+        """ Check that the script is detected once per document and picks
+        the languages of every page """
+
+        backend = FakeOCR(script='Cyrillic')
+        extractor = self.extractor(
+            ocr_backend=backend, ocr_settings=OCRSettings(detect_script=True))
+        extractor.img_to_text()
+        self.assertEqual(backend.detected, 1)
+        with open(extractor.root + '.txt') as f:
+            self.assertEqual(f.read().split(), [
+                'doc_001', 'rus', 'doc_002', 'rus', 'doc_003', 'rus'])
+
+        backend = FakeOCR(script='Cyrillic')
+        extractor = self.extractor(ocr_backend=backend)
+        self.assertEqual(extractor.document_settings().language, 'eng')
+        self.assertEqual(backend.detected, 0)
+
+    def test_cache_key(self):
+        """ Check that pages OCRed with other settings are not shared """
+
+        cache = OCRCache(os.path.join(self.temp.name, 'cache'))
+        extractor = self.extractor(pages=1, ocr_backend=FakeOCR(),
+                                   ocr_cache=cache)
+        extractor.ocr_page(extractor.page_root() + '_001.png',
+                           extractor.page_root() + '_001')
+        extractor = self.extractor(
+            pages=1, ocr_backend=FakeOCR(), ocr_cache=cache,
+            ocr_settings=OCRSettings(psm=6))
+        extractor.ocr_page(extractor.page_root() + '_001.png',
+                           extractor.page_root() + '_001')
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_parallel_pages(self):
+        """ Check that pages OCRed concurrently are joined in page order """
+
+        extractor = self.extractor(
+            pages=12, ocr_backend=FakeOCR(), ocr_workers=4)
+        extractor.img_to_text()
+        with open(extractor.root + '.txt') as f:
+            words = f.read().split()
+        self.assertEqual(words[::2], ['doc_%03d' % page
+                                      for page in range(1, 13)])
+
+    def test_parallel_pages_reuse_threads(self):
+        """ Check that documents are OCRed on the same long-lived threads, so
+        per-thread engines are not reloaded for every document """
+
+        threads = set()
+
+        class ThreadOCR(FakeOCR):
+            def ocr(self, png, out_file, timeout=None, ocr_settings=None):
+                threads.add(threading.get_ident())
+                super().ocr(png, out_file, timeout, ocr_settings)
+
+        for i in range(3):
+            extractor = self.extractor(
+                pages=8, ocr_backend=ThreadOCR(), ocr_workers=2)
+            extractor.img_to_text()
+            extractor.cleanup()
+        self.assertIs(get_ocr_pool(2), get_ocr_pool(2))
+        self.assertLessEqual(len(threads), 2)
+
+
+class TestScratchSpace(TestCase):
+
+    def test_check(self):
+        """ Check that the byte budget is enforced """
+
+        with ScratchSpace(max_bytes=10) as scratch:
+            with open(scratch.path('page_001.png'), 'wb') as f:
+                f.write(b'12345')
+            scratch.check()
+            with open(scratch.path('page_002.png'), 'wb') as f:
+                f.write(b'123456')
+            self.assertRaises(ScratchSpaceExceeded, scratch.check)
+
+    def test_min_free_bytes(self):
+        """ Check that a nearly full scratch volume is refused """
+
+        with ScratchSpace(min_free_bytes=2 ** 62) as scratch:
+            self.assertRaises(ScratchSpaceExceeded, scratch.check)
+        extractor = TextExtraction(
+            doc_path=os.path.join(LOCAL_PATH, 'fixtures/record_text.pdf'),
+            scratch_min_free_bytes=2 ** 62)
+        self.assertRaises(ScratchSpaceExceeded, extractor.scratch.check)
+        extractor.cleanup()
+
+    def test_cleanup(self):
+        """ Check that scratch space is removed on exit """
+
+        with tempfile.TemporaryDirectory() as base_dir:
+            with ScratchSpace(base_dir) as scratch:
+                self.assertTrue(scratch.name.startswith(base_dir))
+                with open(scratch.path('page_001.txt'), 'w') as f:
+                    f.write('text')
+            self.assertEqual(os.listdir(base_dir), [])
+
+
+class TestOCRCache(TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.page = os.path.join(self.temp.name, 'page_001.png')
+        with open(self.page, 'wb') as f:
+            f.write(b'page image')
+        self.text = os.path.join(self.temp.name, 'page_001.txt')
+        with open(self.text, 'w') as f:
+            f.write('Cupcake ipsum')
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def test_key(self):
+        """ Check that keys depend on page image and OCR settings """
+
+        cache = OCRCache(os.path.join(self.temp.name, 'cache'))
+        key = cache.key(self.page, ['-l', 'eng'])
+        self.assertEqual(key, cache.key(self.page, ['-l', 'eng']))
+        self.assertNotEqual(key, cache.key(self.page, ['-l', 'fra']))
+        self.assertNotEqual(
+            cache.key(self.page, ['-l', 'eng'], 'cli'),
+            cache.key(self.page, ['-l', 'eng'], 'api'))
+
+    def test_get_and_put(self):
+        """ Check that cached text is copied out and hits are counted """
+
+        cache = OCRCache(os.path.join(self.temp.name, 'cache'))
+        key = cache.key(self.page, ['-l', 'eng'])
+        out_file = os.path.join(self.temp.name, 'out.txt')
+        self.assertFalse(cache.get(key, out_file))
+        cache.put(key, self.text)
+        self.assertTrue(cache.get(key, out_file))
+        with open(out_file) as f:
+            self.assertEqual(f.read(), 'Cupcake ipsum')
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.stats()['hit_rate'], 0.5)
+
+    def test_evict(self):
+        """ Check that the least recently used entries are evicted """
+
+        cache = OCRCache(os.path.join(self.temp.name, 'cache'), max_bytes=20)
+        cache.put('old', self.text)
+        os.utime(cache.path('old'), (0, 0))
+        cache.put('new', self.text)
+        self.assertFalse(os.path.isfile(cache.path('old')))
+        self.assertTrue(os.path.isfile(cache.path('new')))
+        self.assertTrue(cache.size <= 20)
+
+    def test_concurrent_eviction(self):
+        """ Check that entries evicted by another thread or process are
+        skipped instead of failing the page """
+
+        cache = OCRCache(os.path.join(self.temp.name, 'cache'), max_bytes=20)
+        cache.put('entry', self.text)
+        out_file = os.path.join(self.temp.name, 'out.txt')
+        with mock.patch('os.utime', side_effect=FileNotFoundError):
+            self.assertTrue(cache.get('entry', out_file))
+        with mock.patch('os.stat', side_effect=FileNotFoundError):
+            self.assertEqual(cache.entries(), [])
+
+        entries = cache.entries()
+        os.remove(cache.path('entry'))
+        cache.put('new', self.text)
+        cache.entries = lambda: entries + [
+            (cache.path('new'), os.stat(cache.path('new')))]
+        cache.evict()
+        self.assertTrue(cache.size <= 20)
+
+    def test_img_to_text_with_cache(self):
+        """ Check that OCRing the same document twice hits the cache """
+
+        cache = OCRCache(os.path.join(self.temp.name, 'cache'))
+        doc_path = os.path.join(LOCAL_PATH, 'fixtures/record_no_text.pdf')
+        for i in range(2):
+            extractor = PDFTextExtraction(doc_path=doc_path, ocr_cache=cache)
+            extractor.pdf_to_img()
+            extractor.img_to_text()
+            delete_files()
+        self.assertTrue(cache.stats()['hits'] > 0)
+        self.assertEqual(cache.stats()['hits'], cache.stats()['misses'])
+
+
+class TestAdaptiveLimiter(TestCase):
+
+    def test_aimd(self):
+        """ Check that the limit grows by about one per window of successes
+        and halves on a failure """
+
+        limiter = AdaptiveLimiter(initial=4, max_limit=6)
+        for i in range(4):
+            limiter.release(limiter.acquire())
+        self.assertEqual(limiter.metrics()['limit'], 4)
+        for i in range(5):
+            limiter.release(limiter.acquire())
+        self.assertEqual(limiter.metrics()['limit'], 5)
+        limiter.release(limiter.acquire(), ok=False)
+        metrics = limiter.metrics()
+        self.assertEqual(metrics['limit'], 2)
+        self.assertEqual(metrics['errors'], 1)
+        self.assertGreater(metrics['error_rate'], 0)
+
+        for i in range(100):
+            limiter.release(limiter.acquire())
+        self.assertEqual(limiter.metrics()['limit'], 6)
+
+    def test_target_latency(self):
+        """ Check that slow responses shrink the limit without counting as
+        errors """
+
+        limiter = AdaptiveLimiter(initial=8, target_latency=1)
+        limiter.release(limiter.acquire() - 2)
+        metrics = limiter.metrics()
+        self.assertEqual(metrics['limit'], 4)
+        self.assertEqual(metrics['errors'], 0)
+
+    def test_queue_depth(self):
+        """ Check that acquire blocks at the limit and is counted as queued """
+
+        limiter = AdaptiveLimiter(initial=1)
+        start = limiter.acquire()
+        waiter = threading.Thread(
+            target=lambda: limiter.release(limiter.acquire()))
+        waiter.start()
+        for i in range(100):
+            if limiter.metrics()['queue_depth'] == 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(limiter.metrics()['queue_depth'], 1)
+        self.assertEqual(limiter.metrics()['in_flight'], 1)
+        limiter.release(start)
+        waiter.join()
+        self.assertEqual(limiter.metrics()['in_flight'], 0)
+        self.assertEqual(limiter.metrics()['requests'], 2)
+
+    def test_backoff_delay(self):
+        """ Check that backoff grows exponentially up to its cap """
+
+        for attempt in range(10):
+            delay = backoff_delay(attempt, base=1, cap=8)
+            self.assertTrue(0 <= delay <= min(8, 2 ** attempt))
+
+
+class TestTikaRetries(TestCase):
+
+    def setUp(self):
+        self.extractor = TextExtraction(
+            doc_path=os.path.join(LOCAL_PATH, 'fixtures/record_text.pdf'))
+        self.extractor.tika_limiter = AdaptiveLimiter()
+        self.extractor.BACKOFF_BASE = 0
+        self.requests = []
+
+    def respond(self, *responses):
+        """ Replaces curl with a series of canned responses """
+
+        def send_to_tika(args):
+            self.requests.append(args)
+            response = responses[len(self.requests) - 1]
+            if isinstance(response, int):
+                raise subprocess.CalledProcessError(response, args)
+            return response
+        self.extractor.send_to_tika = send_to_tika
+
+    def test_shared_limiter(self):
+        """ Check that extractors for one server share a limiter """
+
+        self.assertIs(get_tika_limiter('localhost', '9998'),
+                      TextExtraction('record.pdf').tika_limiter)
+
+    def test_retry(self):
+        """ Check that overload and dropped connections are retried and
+        that the status code is stripped from the document """
+
+        self.respond(b'busy\n503', 52, b'text\n200')
+        self.assertEqual(self.extractor.doc_to_text(), b'text')
+        self.assertEqual(len(self.requests), 3)
+        self.assertIn('\n%{http_code}', self.requests[0])
+        metrics = self.extractor.tika_limiter.metrics()
+        self.assertEqual(metrics['errors'], 2)
+        self.assertEqual(metrics['in_flight'], 0)
+
+    def test_no_retry(self):
+        """ Check that client errors fail without retrying """
+
+        self.respond(b'unsupported\n415')
+        with self.assertRaises(TikaError) as context:
+            self.extractor.doc_to_text()
+        self.assertEqual(context.exception.status, 415)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_timeout(self):
+        """ Check that Tika timeouts are not retried but slow the limiter """
+
+        self.respond(28)
+        with self.assertRaises(LimitExceeded):
+            self.extractor.doc_to_text()
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.extractor.tika_limiter.metrics()['limit'], 2)
+
+    def test_gives_up(self):
+        """ Check that retries stop after TIKA_RETRIES """
+
+        self.respond(*[b'\n500'] * (self.extractor.TIKA_RETRIES + 1))
+        with self.assertRaises(TikaError) as context:
+            self.extractor.doc_to_text()
+        self.assertEqual(context.exception.status, 500)
+        self.assertEqual(
+            len(self.requests), self.extractor.TIKA_RETRIES + 1)
+
+
+class TestResourceLimits(TestCase):
+
+    fixture = os.path.join(LOCAL_PATH, 'fixtures/excel_spreadsheet.xlsx')
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp.cleanup()
+        delete_files()
+
+    def test_communicate(self):
+        """ Check that a process running past its timeout is killed """
+
+        args = ['sleep', '10']
+        process = subprocess.Popen(args)
+        start = time.monotonic()
+        with self.assertRaises(LimitExceeded):
+            communicate(process, args, timeout=0.2)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertIsNotNone(process.returncode)
+        self.assertEqual(communicate(
+            subprocess.Popen(['echo', 'ok'], stdout=subprocess.PIPE),
+            ['echo'], timeout=5)[0], b'ok\n')
+
+    def test_scratch_wait_timeout(self):
+        """ Check that ScratchSpace.wait kills a process after its timeout """
+
+        with ScratchSpace() as scratch:
+            process = subprocess.Popen(['sleep', '10'])
+            with self.assertRaises(LimitExceeded):
+                scratch.wait(process, poll_interval=0.05, timeout=0.2)
+            self.assertIsNotNone(process.returncode)
+
+    def test_tika_timeout(self):
+        """ Check that Tika requests are sent with the Tika timeout """
+
+        extractor = TextExtraction(
+            self.fixture, limits=ResourceLimits(tika_timeout=30))
+        self.assertIn('--max-time', extractor.text_args)
+        self.assertIn('30', extractor.metadata_args)
+        extractor = TextExtraction(
+            self.fixture, limits=ResourceLimits(tika_timeout=None))
+        self.assertNotIn('--max-time', extractor.text_args)
+
+    def test_max_text_bytes(self):
+        """ Check that reading stops once a response is over the limit """
+
+        extractor = TextExtraction(
+            self.fixture, limits=ResourceLimits(max_text_bytes=100))
+        extractor.READ_CHUNK = 16
+        with self.assertRaises(LimitExceeded):
+            extractor.send_to_tika(['cat', self.fixture])
+        extractor.limits.max_text_bytes = None
+        with open(self.fixture, 'rb') as f:
+            self.assertEqual(
+                extractor.send_to_tika(['cat', self.fixture]), f.read())
+
+    def test_max_input_bytes(self):
+        """ Check that oversized documents fail before reaching Tika """
+
+        extractor = TextExtraction(
+            self.fixture, limits=ResourceLimits(max_input_bytes=100))
+        extractor.send_to_tika = None
+        with self.assertRaises(LimitExceeded):
+            extractor.extract()
+        self.assertFalse(os.path.exists(extractor.root + '.txt'))
+
+    def test_quarantine(self):
+        """ Check that text_extractor records failures in the quarantine,
+        moves on and skips quarantined documents afterwards """
+
+        quarantine = Quarantine(os.path.join(self.temp.name, 'quarantine'))
+        limits = ResourceLimits(max_input_bytes=100)
+        text_extractor(self.fixture, limits=limits, quarantine=quarantine)
+        self.assertIn(self.fixture, quarantine)
+        record = quarantine.records()[0]
+        self.assertEqual(record['doc_path'], self.fixture)
+        self.assertEqual(record['error'], 'LimitExceeded')
+
+        with self.assertRaises(LimitExceeded):
+            text_extractor(self.fixture, limits=limits)
+        text_extractor(self.fixture, quarantine=quarantine)
+        self.assertFalse(os.path.exists(
+            os.path.join(LOCAL_PATH, 'fixtures/excel_spreadsheet.txt')))
+
+        quarantine.remove(self.fixture)
+        self.assertNotIn(self.fixture, quarantine)
+
+
+class TestDocumentProfiler(TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.profiler = DocumentProfiler(self.temp.name, threshold=0.1)
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def test_profile(self):
+        """ Check that only slow documents keep their profile and that the
+        report ranks them from the slowest """
+
+        for doc_id, seconds in (('fast', 0), ('slow', 0.15),
+                                ('slower/doc.pdf', 0.3)):
+            with self.profiler.profile(doc_id) as profile:
+                with profile.timed('gs'):
+                    time.sleep(seconds)
+                with profile.timed('gs'):
+                    pass
+        ranked = self.profiler.report()
+        self.assertEqual([record['doc_id'] for record in ranked],
+                         ['slower/doc.pdf', 'slow'])
+        self.assertEqual(ranked[0]['commands']['gs']['count'], 2)
+        self.assertGreaterEqual(ranked[0]['commands']['gs']['seconds'], 0.3)
+        self.assertTrue(os.path.exists(ranked[0]['profile']))
+        self.assertTrue(os.path.exists(ranked[0]['profile'][:-5] + '.txt'))
+        self.assertEqual(len(os.listdir(self.temp.name)), 5)
+
+        with open(os.path.join(self.temp.name, 'slow_documents.json')) as f:
+            report = json.load(f)
+        self.assertEqual(report['documents'], 3)
+        self.assertEqual(report['slow_documents'], ranked)
+
+    def test_run_extractor(self):
+        """ Check that extractors record their Tika time in the profile """
+
+        def send_to_tika(args):
+            time.sleep(0.1)
+            return b'text\n200'
+
+        def make_extractor():
+            extractor = TextExtraction(os.path.join(self.temp.name, 'doc'))
+            extractor.send_to_tika = send_to_tika
+            return extractor
+
+        run_extractor(make_extractor, 'doc', profiler=self.profiler)
+        record = self.profiler.report()[0]
+        self.assertEqual(record['doc_id'], 'doc')
+        self.assertEqual(record['commands']['tika']['count'], 2)
+
+
+class TestNearDuplicateIndex(TestCase):
+
+    text = ' '.join(
+        'Cupcake ipsum dolor sit amet record %d released' % i
+        for i in range(40))
+
+    def test_minhash(self):
+        """ Check that small edits keep signatures similar """
+
+        edited = self.text.replace('record 39', 'record 93')
+        self.assertTrue(
+            similarity(minhash(self.text), minhash(edited)) > 0.8)
+        self.assertTrue(
+            similarity(minhash(self.text), minhash('Chupa chups')) < 0.2)
+        self.assertIsNone(minhash('  '))
+
+    def test_long_text(self):
+        """ Check that long texts are sampled and still compare """
+
+        text = ' '.join('record %d of the archive' % i for i in range(5000))
+        self.assertEqual(len(shingles(text)), MAX_SHINGLES)
+        index = NearDuplicateIndex()
+        edited = text.replace('record 4999', 'record 9994')
+        self.assertTrue(similarity(
+            index.signature(text), index.signature(edited)) > 0.8)
+
+    def test_query(self):
+        """ Check that the earliest near-duplicate is returned and that a
+        document never matches itself or later documents """
+
+        index = NearDuplicateIndex()
+        signature = index.signature(self.text)
+        self.assertIsNone(index.query(signature, 'first'))
+        index.add('first', signature)
+        index.add('second', signature)
+        self.assertEqual(index.query(signature, 'second'), 'first')
+        self.assertEqual(index.query(signature, 'third'), 'first')
+        self.assertIsNone(index.query(signature, 'first'))
+        self.assertIsNone(index.query(index.signature('Chupa chups')))
+
+    def test_persistence(self):
+        """ Check that signatures persist across runs """
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'duplicates.sqlite')
+            index = NearDuplicateIndex(path)
+            index.add('first', index.signature(self.text))
+            index.close()
+            index = NearDuplicateIndex(path)
+            self.assertEqual(
+                index.query(index.signature(self.text), 'second'), 'first')
+            index.close()
+
+    def test_query_pages(self):
+        """ Check that only documents with the same page count match and
+        that last page signatures are kept """
+
+        index = NearDuplicateIndex()
+        signature = index.signature(self.text)
+        last = index.signature('Chupa chups')
+        index.add('first', signature, pages=3, last_signature=last)
+        self.assertEqual(index.query(signature, 'second', pages=3), 'first')
+        self.assertIsNone(index.query(signature, 'second', pages=4))
+        self.assertEqual(index.last_signature('first'), last)
+        self.assertIsNone(index.last_signature('second'))
+
+    def test_copy_near_duplicate_checks_pages(self):
+        """ Check that a shared first page is not enough to reuse text:
+        the page count and the last page must match too """
+
+        index = NearDuplicateIndex()
+        signature = index.signature(self.text)
+        last = index.signature('Chupa chups lollipop jelly beans')
+        index.add('first', signature, pages=3, last_signature=last)
+        saved = []
+        extractor = PDFTextExtraction(
+            doc_path=os.path.join(LOCAL_PATH, 'fixtures/record_no_text.pdf'),
+            duplicate_index=index, ocr_backend=FakeOCR())
+        extractor.read_saved_text = lambda doc_id: 'text of ' + doc_id
+        extractor.save = lambda text, ext: saved.append(text)
+
+        extractor.tika_metadata = {}
+        self.assertFalse(extractor.copy_near_duplicate(signature))
+        extractor.tika_metadata = {'xmpTPg:NPages': '4'}
+        self.assertFalse(extractor.copy_near_duplicate(signature))
+
+        extractor.tika_metadata = {'xmpTPg:NPages': ['3']}
+        extractor.page_signature = lambda page, page_root: index.signature(
+            'Redaction notice for record %d' % page)
+        self.assertFalse(extractor.copy_near_duplicate(signature))
+        self.assertEqual(saved, [])
+
+        extractor.page_signature = lambda page, page_root: last
+        self.assertTrue(extractor.copy_near_duplicate(signature))
+        self.assertEqual(saved, ['text of first'])
+
+    def test_extract_skips_ocr_for_near_duplicate(self):
+        """ Check that a scan whose first page matches an already processed
+        document gets that document's text without full OCR """
+
+        index = NearDuplicateIndex()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for name in ('first.pdf', 'second.pdf'):
+                shutil.copyfile(
+                    os.path.join(LOCAL_PATH, 'fixtures/record_no_text.pdf'),
+                    os.path.join(temp_dir, name))
+            first = PDFTextExtraction(
+                doc_path=os.path.join(temp_dir, 'first.pdf'),
+                duplicate_index=index)
+            first.extract()
+            second = PDFTextExtraction(
+                doc_path=os.path.join(temp_dir, 'second.pdf'),
+                duplicate_index=index)
+            second.img_to_text = None
+            second.extract()
+            with open(first.root + '.txt') as f:
+                first_text = f.read()
+            with open(second.root + '.txt') as f:
+                self.assertEqual(f.read(), first_text)
+
+
+class TestMetadataCatalog(TestCase):
+
+    def setUp(self):
+        self.catalog = MetadataCatalog()
+        documents = [
+            ('a', '20150331', 'xls', '2015-02-01'),
+            ('b', '20150331', 'pdf', '2015-03-01'),
+            ('c', '20160101', 'xls', '2016-01-01'),
+        ]
+        for name, date_dir, file_type, date_released in documents:
+            self.catalog.add(
+                '/agency/%s/%s_metadata.json' % (date_dir, name), 'agency',
+                date_dir, {'file_type': file_type, 'pages': 2,
+                           'date_released': date_released,
+                           'doc_location': name + '.' + file_type},
+                mtime=1.0)
+        self.catalog.commit()
+
+    def tearDown(self):
+        self.catalog.close()
+
+    def test_manifest(self):
+        """ Check that a manifest is built for one dated directory """
+
+        manifest = self.catalog.manifest('agency', '20150331')
+        self.assertEqual(
+            [doc['doc_location'] for doc in manifest], ['a.xls', 'b.pdf'])
+        self.assertEqual(manifest[0]['pages'], 2)
+
+    def test_query(self):
+        """ Check cross-corpus queries, like xls released in 2015 """
+
+        documents = self.catalog.query(
+            file_type='xls', released_from='2015-01-01',
+            released_to='2015-12-31')
+        self.assertEqual(
+            [doc['doc_location'] for doc in documents], ['a.xls'])
+        self.assertEqual(len(self.catalog.query(agency='agency')), 3)
+
+    def test_remove_missing(self):
+        """ Check that rows of a directory's documents that were not seen
+        are deleted and other directories are untouched """
+
+        removed = self.catalog.remove_missing(
+            'agency', '20150331', ['/agency/20150331/b_metadata.json'])
+        self.catalog.commit()
+        self.assertEqual(removed, 1)
+        self.assertEqual(
+            [doc['doc_location'] for doc in
+             self.catalog.manifest('agency', '20150331')], ['b.pdf'])
+        self.assertEqual(len(self.catalog.manifest('agency', '20160101')), 1)
+
+    def test_get_metadata(self):
+        """ Check that cached metadata is only returned for the same file
+        modification time """
+
+        path = '/agency/20150331/a_metadata.json'
+        self.assertEqual(
+            self.catalog.get_metadata(path, 1.0)['file_type'], 'xls')
+        self.assertIsNone(self.catalog.get_metadata(path, 2.0))
+
+    def test_raw_metadata(self):
+        """ Check that raw Tika metadata recorded during extraction can be
+        read back and invalidates normalized metadata """
+
+        path = '/agency/20150331/a_metadata.json'
+        self.catalog.record_raw(
+            path, '{"dc:format": "application/pdf"}', 3.0)
+        self.assertEqual(
+            self.catalog.get_raw(path, 3.0), {'dc:format': 'application/pdf'})
+        self.assertIsNone(self.catalog.get_raw(path, 4.0))
+        self.assertIsNone(self.catalog.get_metadata(path, 1.0))
+        self.assertIsNone(
+            self.catalog.get_raw('/missing_metadata.json', 3.0))
+
 
 class Testtextextractor(TestCase):
 
@@ -189,15 +1005,13 @@ class Testtextextractor(TestCase):
             self.assertTrue(os.path.isfile(root + '.txt'))
             self.assertTrue(os.path.isfile(root + '_metadata.json'))
 
-        # Check that only doc with no text used OCR
-        self.assertTrue(os.path.isfile(
-            os.path.join(LOCAL_PATH, 'fixtures/record_no_text_001.png')))
-        self.assertTrue(os.path.isfile(
-            os.path.join(LOCAL_PATH, 'fixtures/record_some_text_001.png')))
-        self.assertFalse(os.path.isfile(
-            os.path.join(LOCAL_PATH, 'fixtures/record_text_001.png')))
-        self.assertFalse(os.path.isfile(
-            os.path.join(LOCAL_PATH, 'fixtures/excel_spreadsheet_001.png')))
+        # Check that OCR produced text and left no page images behind
+        text_file = os.path.join(LOCAL_PATH, 'fixtures/record_no_text.txt')
+        with open(text_file) as f:
+            self.assertTrue(f.read().strip())
+        base_files = [os.path.splitext(doc)[0] for doc in docs_to_convert]
+        for png in file_iterator(base_files, ['_001.png']):
+            self.assertFalse(os.path.isfile(png))
 
 
 class TestTextExtractionS3(TestCase):
@@ -227,6 +1041,61 @@ class TestTextExtractionS3(TestCase):
         item = list(self.extractor.s3_bucket.list('testfile_metadata.json'))
         self.assertEqual(item[0].name, 'testfile_metadata.json')
 
+    @moto.mock_s3
+    def test_stream(self):
+        """ Test that a streaming TextExtractionS3 pipes the s3 object into
+        the Tika request without downloading it """
+
+        conn = boto.connect_s3()
+        conn.create_bucket('testbucket')
+        s3_bucket = conn.get_bucket('testbucket')
+        k = Key(s3_bucket)
+        k.key = 'testfile.xlsx'
+        fixture = os.path.join(LOCAL_PATH, 'fixtures/excel_spreadsheet.xlsx')
+        k.set_contents_from_filename(fixture)
+
+        extractor = TextExtractionS3(
+            file_key='testfile.xlsx', s3_bucket=s3_bucket, stream=True)
+        self.assertFalse(os.path.exists(extractor.doc_path))
+
+        # The document path in the request is replaced by stdin
+        extractor.STREAM_CHUNK = 1024
+        with open(fixture, 'rb') as f:
+            self.assertEqual(
+                extractor.stream_to_tika(['cat', extractor.doc_path]),
+                f.read())
+
+        extractor.extract()
+        self.assertFalse(os.path.exists(extractor.doc_path))
+        item = list(s3_bucket.list('testfile.txt'))
+        self.assertEqual(item[0].name, 'testfile.txt')
+
+    @moto.mock_s3
+    def test_missing_key(self):
+        """ Test that a missing s3 object is reported as DocumentNotFound,
+        which quarantines the document """
+
+        conn = boto.connect_s3()
+        conn.create_bucket('testbucket')
+        s3_bucket = conn.get_bucket('testbucket')
+        self.assertRaises(
+            DocumentNotFound, TextExtractionS3, file_key='missing.xlsx',
+            s3_bucket=s3_bucket)
+
+        extractor = TextExtractionS3(
+            file_key='missing.xlsx', s3_bucket=s3_bucket, stream=True,
+            limits=ResourceLimits(max_input_bytes=1024))
+        self.assertRaises(DocumentNotFound, extractor.check_input_size)
+        self.assertRaises(DocumentNotFound, extractor.stream_to_tika,
+                          ['cat', extractor.doc_path])
+        extractor.cleanup()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            quarantine = Quarantine(temp_dir)
+            text_extractor_s3('missing.xlsx', s3_bucket, stream=False,
+                              quarantine=quarantine)
+            self.assertIn('missing.xlsx', quarantine)
+
 
 class TestPDFTextExtractionS3(TestCase):
 
@@ -257,6 +1126,67 @@ class TestPDFTextExtractionS3(TestCase):
         item = list(self.extractor.s3_bucket.list('testfile_metadata.json'))
         self.assertEqual(item[0].name, 'testfile_metadata.json')
 
+    @moto.mock_s3
+    def test_stream_downloads_once(self):
+        """ Test that a streaming PDFTextExtractionS3 downloads the document
+        for the first Tika request instead of streaming it """
+
+        conn = boto.connect_s3()
+        conn.create_bucket('testbucket')
+        s3_bucket = conn.get_bucket('testbucket')
+        k = Key(s3_bucket)
+        k.key = 'testfile.pdf'
+        fixture = os.path.join(LOCAL_PATH, 'fixtures/record_text.pdf')
+        k.set_contents_from_filename(fixture)
+
+        extractor = PDFTextExtractionS3(
+            file_key='testfile.pdf', s3_bucket=s3_bucket, stream=True)
+        self.assertFalse(os.path.exists(extractor.doc_path))
+
+        def stream_to_tika(args):
+            raise AssertionError('PDF was streamed')
+
+        extractor.stream_to_tika = stream_to_tika
+        with open(fixture, 'rb') as f:
+            self.assertEqual(
+                extractor.send_to_tika(['cat', extractor.doc_path]),
+                f.read())
+        self.assertTrue(os.path.exists(extractor.doc_path))
+        extractor.cleanup()
+
+    @moto.mock_s3
+    def test_scratch_dir(self):
+        """ Test that scratch settings reach the scratch space, which holds
+        the downloaded document and is removed by cleanup """
+
+        conn = boto.connect_s3()
+        conn.create_bucket('testbucket')
+        s3_bucket = conn.get_bucket('testbucket')
+        k = Key(s3_bucket)
+        k.key = 'testfile.pdf'
+        k.set_contents_from_filename(
+            os.path.join(LOCAL_PATH, 'fixtures/record_text.pdf'))
+        with tempfile.TemporaryDirectory() as scratch_dir:
+            extractor = PDFTextExtractionS3(
+                file_key='testfile.pdf', s3_bucket=s3_bucket,
+                scratch_dir=scratch_dir, scratch_max_bytes=10 ** 6,
+                scratch_min_free_bytes=5678)
+            self.assertEqual(extractor.scratch_max_bytes, 10 ** 6)
+            self.assertTrue(extractor.scratch.name.startswith(scratch_dir))
+            self.assertEqual(extractor.scratch.max_bytes, 10 ** 6)
+            self.assertEqual(extractor.scratch.min_free_bytes, 5678)
+            self.assertEqual(
+                os.path.dirname(extractor.doc_path), extractor.scratch.name)
+            extractor.cleanup()
+            self.assertEqual(os.listdir(scratch_dir), [])
+
+            # The document counts against the job's budget
+            self.assertRaises(
+                ScratchSpaceExceeded, PDFTextExtractionS3,
+                file_key='testfile.pdf', s3_bucket=s3_bucket,
+                scratch_dir=scratch_dir, scratch_max_bytes=1234)
+            self.assertEqual(os.listdir(scratch_dir), [])
+
 
 class TesttextextractorS3(TestCase):
 
@@ -0,0 +1,161 @@
+import json
+import os
+import sqlite3
+import threading
+
+
+"""
+An embedded SQLite catalog of document metadata. Extraction records the raw
+Tika metadata and PrepareDocs records the normalized fields, so manifests and
+cross-corpus queries do not need to walk the file system or re-read JSON.
+"""
+
+COLUMNS = ['file_type', 'title', 'pages', 'date_created', 'date_released']
+
+
+class MetadataCatalog:
+    """ MetadataCatalog stores one row per `_metadata.json` file, keyed on
+    its absolute path, with indexes on the fields manifests are queried by.
+    """
+
+    def __init__(self, path=':memory:'):
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS documents ('
+                'metadata_path TEXT PRIMARY KEY, agency TEXT, date_dir TEXT, '
+                'doc_location TEXT, file_type TEXT, title TEXT, pages TEXT, '
+                'date_created TEXT, date_released TEXT, metadata TEXT, '
+                'raw_metadata TEXT, raw_mtime REAL, mtime REAL)')
+            columns = [row['name'] for row in self.connection.execute(
+                'PRAGMA table_info(documents)')]
+            if 'raw_mtime' not in columns:
+                self.connection.execute(
+                    'ALTER TABLE documents ADD COLUMN raw_mtime REAL')
+            for columns in ('agency, date_dir', 'date_dir', 'file_type',
+                            'date_created', 'date_released'):
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS documents_%s '
+                    'ON documents (%s)' % (
+                        columns.replace(', ', '_'), columns))
+
+    def upsert(self, metadata_path, fields):
+        """ Sets the fields of a document's row, creating it if needed. Uses
+        INSERT OR IGNORE and UPDATE, since SQLite only supports upserts from
+        3.24. Callers hold the lock """
+
+        metadata_path = os.path.abspath(metadata_path)
+        self.connection.execute(
+            'INSERT OR IGNORE INTO documents (metadata_path) VALUES (?)',
+            (metadata_path,))
+        self.connection.execute(
+            'UPDATE documents SET %s WHERE metadata_path = ?' % ', '.join(
+                '%s = ?' % column for column, value in fields),
+            [value for column, value in fields] + [metadata_path])
+
+    def record_raw(self, metadata_path, raw_metadata, mtime=None):
+        """ Records the raw Tika metadata of a document during extraction,
+        with the modification time of the metadata file it was saved to """
+
+        with self.lock, self.connection:
+            self.upsert(metadata_path, [
+                ('raw_metadata', raw_metadata), ('raw_mtime', mtime),
+                ('mtime', None)])
+
+    def get_raw(self, metadata_path, mtime):
+        """ Returns the raw Tika metadata of a document as a dict, or None
+        if it was not recorded for a file with the same modification time
+        """
+
+        row = self.connection.execute(
+            'SELECT raw_metadata FROM documents '
+            'WHERE metadata_path = ? AND raw_mtime = ?',
+            (os.path.abspath(metadata_path), mtime)).fetchone()
+        if row and row['raw_metadata']:
+            try:
+                return json.loads(row['raw_metadata'])
+            except ValueError:
+                return {}
+
+    def get_metadata(self, metadata_path, mtime):
+        """ Returns normalized metadata if it was recorded for a file with
+        the same modification time """
+
+        row = self.connection.execute(
+            'SELECT metadata FROM documents '
+            'WHERE metadata_path = ? AND mtime = ?',
+            (os.path.abspath(metadata_path), mtime)).fetchone()
+        if row and row['metadata']:
+            return json.loads(row['metadata'])
+
+    def add(self, metadata_path, agency, date_dir, metadata, mtime=None):
+        """ Records the normalized metadata of a document. Call commit()
+        once a batch of documents has been added """
+
+        values = [metadata.get(column) for column in COLUMNS]
+        if values[2] is not None:
+            values[2] = str(values[2])
+        with self.lock:
+            self.upsert(metadata_path, [
+                ('agency', agency), ('date_dir', date_dir),
+                ('doc_location', metadata.get('doc_location'))] +
+                list(zip(COLUMNS, values)) +
+                [('metadata', json.dumps(metadata)), ('mtime', mtime)])
+
+    def remove_missing(self, agency, date_dir, metadata_paths):
+        """ Deletes the rows of a time-stamped directory whose metadata file
+        is not among metadata_paths, such as documents removed from disk.
+        Call commit() afterwards """
+
+        metadata_paths = set(os.path.abspath(path) for path in metadata_paths)
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT metadata_path FROM documents '
+                'WHERE agency = ? AND date_dir = ?', (agency, date_dir))
+            missing = [(row['metadata_path'],) for row in rows
+                       if row['metadata_path'] not in metadata_paths]
+            self.connection.executemany(
+                'DELETE FROM documents WHERE metadata_path = ?', missing)
+        return len(missing)
+
+    def commit(self):
+        """ Commits documents added since the last commit """
+
+        with self.lock:
+            self.connection.commit()
+
+    def manifest(self, agency, date_dir):
+        """ Returns the manifest of one time-stamped directory """
+
+        return self.query(agency=agency, date_dir=date_dir)
+
+    def query(self, agency=None, date_dir=None, file_type=None,
+              released_from=None, released_to=None, created_from=None,
+              created_to=None):
+        """ Returns normalized metadata of documents matching every given
+        filter. Date bounds are inclusive YYYY-MM-DD strings """
+
+        filters = [
+            ('agency = ?', agency),
+            ('date_dir = ?', date_dir),
+            ('file_type = ?', file_type),
+            ('date_released >= ?', released_from),
+            ('date_released <= ?', released_to),
+            ('date_created >= ?', created_from),
+            ('date_created <= ?', created_to),
+        ]
+        filters = [(clause, value) for clause, value in filters
+                   if value is not None]
+        sql = 'SELECT metadata FROM documents WHERE metadata IS NOT NULL'
+        for clause, value in filters:
+            sql += ' AND ' + clause
+        sql += ' ORDER BY agency, date_dir, doc_location'
+        rows = self.connection.execute(
+            sql, [value for clause, value in filters])
+        return [json.loads(row['metadata']) for row in rows]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,195 @@
+import heapq
+import json
+import random
+import re
+import sqlite3
+import threading
+import zlib
+
+
+"""
+MinHash fingerprints and a locality sensitive hashing (LSH) index for finding
+near-duplicate documents, such as the same record re-scanned or exported to a
+different format. The index is kept in SQLite so it persists across runs.
+"""
+
+TOKENS = re.compile('\\w+')
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+# Shingles kept per text, so long pages cost the same as short ones
+MAX_SHINGLES = 1000
+
+
+def shingles(text, size=3, max_shingles=MAX_SHINGLES):
+    """ Returns the hashes of overlapping word n-grams in a text. Past
+    `max_shingles`, only the smallest hashes are kept, a sample that is the
+    same for every text and so still estimates their similarity """
+
+    words = TOKENS.findall(text.lower())
+    size = min(size, len(words))
+    if not size:
+        return set()
+    hashes = set(
+        zlib.crc32(' '.join(words[i:i + size]).encode('utf-8'))
+        for i in range(len(words) - size + 1))
+    if max_shingles and len(hashes) > max_shingles:
+        hashes = set(heapq.nsmallest(max_shingles, hashes))
+    return hashes
+
+
+def permutations(num_perm, seed=1):
+    """ Returns the hash permutations shared by every signature """
+
+    generator = random.Random(seed)
+    return [
+        (generator.randint(1, MERSENNE_PRIME - 1),
+         generator.randint(0, MERSENNE_PRIME - 1))
+        for i in range(num_perm)]
+
+
+def minhash(text, num_perm=64, perms=None):
+    """ Returns the MinHash signature of a text, or None if the text has no
+    words. `perms` are permutations computed ahead of time for num_perm """
+
+    hashes = shingles(text)
+    if not hashes:
+        return None
+    return [
+        min((a * h + b) % MERSENNE_PRIME & MAX_HASH for h in hashes)
+        for a, b in perms or permutations(num_perm)]
+
+
+def similarity(first, second):
+    """ Estimates the Jaccard similarity of two signatures """
+
+    matches = sum(1 for a, b in zip(first, second) if a == b)
+    return matches / len(first)
+
+
+class NearDuplicateIndex:
+    """ NearDuplicateIndex stores MinHash signatures in SQLite, with one row
+    per LSH band so that candidates are found with an indexed lookup. The
+    first document added is treated as the original of its near-duplicates,
+    also on later runs. Each document may also record its page count and
+    the signature of its last page, so that a match can be confirmed beyond
+    the page it was found by. """
+
+    def __init__(self, path=':memory:', num_perm=64, bands=16,
+                 threshold=0.8):
+
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.permutations = permutations(num_perm)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS documents ('
+                'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'doc_id TEXT UNIQUE, signature TEXT, pages INTEGER, '
+                'last_signature TEXT)')
+            columns = [row[1] for row in self.connection.execute(
+                'PRAGMA table_info(documents)')]
+            for column, column_type in (('pages', 'INTEGER'),
+                                        ('last_signature', 'TEXT')):
+                if column not in columns:
+                    self.connection.execute(
+                        'ALTER TABLE documents ADD COLUMN %s %s' % (
+                            column, column_type))
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS bands ('
+                'band INTEGER, bucket TEXT, seq INTEGER)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS bands_bucket '
+                'ON bands (band, bucket)')
+
+    def signature(self, text):
+        """ Returns the MinHash signature of a text for this index """
+
+        return minhash(text, self.num_perm, self.permutations)
+
+    def buckets(self, signature):
+        """ Returns the LSH bucket of each band of a signature """
+
+        return [
+            (band, ','.join(map(str, signature[
+                band * self.rows:(band + 1) * self.rows])))
+            for band in range(self.bands)]
+
+    def seq(self, doc_id):
+        """ Returns the insertion order of a document, if indexed """
+
+        row = self.connection.execute(
+            'SELECT seq FROM documents WHERE doc_id = ?', (doc_id,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, doc_id, signature, pages=None, last_signature=None):
+        """ Adds or updates the signature of a document, with its page count
+        and the signature of its last page when they are known """
+
+        if signature is None:
+            return
+        values = (json.dumps(signature), pages,
+                  json.dumps(last_signature) if last_signature else None)
+        with self.lock, self.connection:
+            seq = self.seq(doc_id)
+            if seq is None:
+                seq = self.connection.execute(
+                    'INSERT INTO documents (signature, pages, '
+                    'last_signature, doc_id) VALUES (?, ?, ?, ?)',
+                    values + (doc_id,)).lastrowid
+            else:
+                self.connection.execute(
+                    'UPDATE documents SET signature = ?, pages = ?, '
+                    'last_signature = ? WHERE seq = ?', values + (seq,))
+                self.connection.execute(
+                    'DELETE FROM bands WHERE seq = ?', (seq,))
+            self.connection.executemany(
+                'INSERT INTO bands (band, bucket, seq) VALUES (?, ?, ?)',
+                [(band, bucket, seq)
+                 for band, bucket in self.buckets(signature)])
+
+    def query(self, signature, doc_id=None, pages=None):
+        """ Returns the id of the earliest indexed document that is a
+        near-duplicate of the signature. When `doc_id` is already indexed
+        only documents added before it are considered, and with `pages` only
+        documents with that many pages. """
+
+        if signature is None:
+            return None
+        with self.lock:
+            own_seq = self.seq(doc_id) if doc_id else None
+            candidates = set()
+            for band, bucket in self.buckets(signature):
+                candidates.update(row[0] for row in self.connection.execute(
+                    'SELECT seq FROM bands WHERE band = ? AND bucket = ?',
+                    (band, bucket)))
+            for seq in sorted(candidates):
+                if own_seq is not None and seq >= own_seq:
+                    break
+                match_id, match_signature, match_pages = \
+                    self.connection.execute(
+                        'SELECT doc_id, signature, pages FROM documents '
+                        'WHERE seq = ?', (seq,)).fetchone()
+                if match_id == doc_id:
+                    continue
+                if pages is not None and match_pages != pages:
+                    continue
+                if similarity(signature, json.loads(match_signature)) >= \
+                        self.threshold:
+                    return match_id
+
+    def last_signature(self, doc_id):
+        """ Returns the signature of the last page of an indexed document, if
+        it was recorded """
+
+        row = self.connection.execute(
+            'SELECT last_signature FROM documents WHERE doc_id = ?',
+            (doc_id,)).fetchone()
+        if row and row[0]:
+            return json.loads(row[0])
+
+    def close(self):
+        self.connection.close()
@@ -1,27 +1,515 @@
+import contextlib
+import functools
 import glob
+import hashlib
+import importlib.util
+import json
 import logging
 import os
 import re
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
 
-from boto.s3.key import Key
-from boto.s3.connection import S3Connection
+from concurrent.futures import ThreadPoolExecutor
 
+from textextraction.duplicates import similarity
+from textextraction.limiter import AdaptiveLimiter, backoff_delay
+from textextraction.limits import LimitExceeded, ResourceLimits, communicate
 
 """
 The functions below are minimal Python wrappers around Ghostscript, Tika, and
 Tesseract. They are intended to simplify converting pdf files into usable text.
 """
 
+# Words of three or more letters, used to judge if extraction produced text
+WORDS = re.compile('[A-Za-z]{3,}')
+
+
+def s3_key(s3_bucket, key_name):
+    """ Returns a boto Key for an object in a bucket. boto is only imported
+    here so that local extraction does not load the S3 stack """
+
+    from boto.s3.key import Key
+    k = Key(s3_bucket)
+    k.key = key_name
+    return k
+
+
+@functools.lru_cache(maxsize=None)
+def has_tesserocr():
+    """ Returns True if the tesserocr bindings are installed """
+
+    return importlib.util.find_spec('tesserocr') is not None
+
+
+class OCRSettings:
+    """ OCRSettings holds the Tesseract options for a document: the
+    `languages` to load, the page segmentation mode `psm` (for example 6 for
+    the uniform blocks of tables and forms), the engine mode `oem` and a
+    `whitelist` of the only characters to recognize. With `detect_script`,
+    the script of the first page is detected with Tesseract's OSD and the
+    languages are replaced by those `script_languages` maps it to, so
+    documents in other scripts get the right models while English documents
+    do not pay for multi-language OCR on every page. """
+
+    # Languages to OCR with for scripts reported by OSD. Other scripts,
+    # including Latin, keep the configured languages
+    SCRIPT_LANGUAGES = {
+        'Arabic': ['ara'],
+        'Cyrillic': ['rus'],
+        'Devanagari': ['hin'],
+        'Greek': ['ell'],
+        'Han': ['chi_sim', 'chi_tra'],
+        'Hangul': ['kor'],
+        'Hebrew': ['heb'],
+        'Japanese': ['jpn'],
+        'Thai': ['tha'],
+    }
+
+    def __init__(self, languages=('eng',), psm=None, oem=None,
+                 whitelist=None, detect_script=False, script_languages=None):
+
+        if isinstance(languages, str):
+            languages = languages.split('+')
+        self.languages = list(languages)
+        self.psm = psm
+        self.oem = oem
+        self.whitelist = whitelist
+        self.detect_script = detect_script
+        self.script_languages = script_languages or self.SCRIPT_LANGUAGES
+
+    @property
+    def language(self):
+        """ Returns the languages in Tesseract's `eng+fra` form """
+
+        return '+'.join(self.languages)
+
+    def args(self):
+        """ Returns the settings as tesseract command line options """
+
+        args = ['-l', self.language]
+        if self.psm is not None:
+            args.extend(['--psm', str(self.psm)])
+        if self.oem is not None:
+            args.extend(['--oem', str(self.oem)])
+        if self.whitelist:
+            args.extend(['-c', 'tessedit_char_whitelist=' + self.whitelist])
+        return args
+
+    def for_script(self, script):
+        """ Returns settings with the languages of a detected script, or
+        these settings if the script has no languages of its own """
+
+        languages = self.script_languages.get(script)
+        if not languages:
+            return self
+        return OCRSettings(languages, self.psm, self.oem, self.whitelist,
+                           script_languages=self.script_languages)
+
+
+class TesseractCLI:
+    """ OCR backend that launches the `tesseract` command line tool for every
+    page. Slower than TesseractAPI on small pages, since the language model
+    is reloaded each time, but it has no Python dependencies. """
+
+    name = 'cli'
+
+    def __init__(self, language='eng', ocr_settings=None):
+
+        self.ocr_settings = ocr_settings or OCRSettings(language)
+        self.language = self.ocr_settings.language
+
+    def settings(self, ocr_settings=None):
+        """ Returns the Tesseract options used by this backend, or for the
+        given OCRSettings """
+
+        return (ocr_settings or self.ocr_settings).args()
+
+    def ocr(self, png, out_file, timeout=None, ocr_settings=None):
+        """ OCRs a png image into `out_file`.txt, killing tesseract after
+        `timeout` seconds """
+
+        args = ['tesseract', png, out_file] + self.settings(ocr_settings)
+        doc_process = subprocess.Popen(
+            args=args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        communicate(doc_process, args, timeout)
+        if doc_process.returncode:
+            raise subprocess.CalledProcessError(doc_process.returncode,
+                                                args)
+
+    def detect_script(self, png, timeout=None):
+        """ Returns the script OSD detects on a page, such as `Latin` or
+        `Cyrillic`, or None if detection fails """
+
+        args = ['tesseract', png, 'stdout', '--psm', '0']
+        process = subprocess.Popen(
+            args=args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = communicate(process, args, timeout)[0].decode('utf-8')
+        for line in output.splitlines():
+            if line.startswith('Script:'):
+                return line.split(':', 1)[1].strip()
+        logging.warning("script detection failed on %s: %s", png, output)
+
+
+class TesseractAPI(TesseractCLI):
+    """ OCR backend that runs libtesseract in process via the tesserocr
+    bindings. An engine is loaded once per worker thread, language and
+    engine mode and is reused across pages and documents. """
+
+    name = 'api'
+    _local = threading.local()
+
+    def __init__(self, language='eng', ocr_settings=None):
+
+        import tesserocr
+        self.tesserocr = tesserocr
+        super().__init__(language, ocr_settings)
+
+    def engine(self, ocr_settings=None):
+        """ Returns this thread's engine for the languages and engine mode
+        of the settings, set to their page segmentation and whitelist """
+
+        ocr_settings = ocr_settings or self.ocr_settings
+        if not hasattr(self._local, 'engines'):
+            self._local.engines = {}
+        key = (ocr_settings.language, ocr_settings.oem)
+        if key not in self._local.engines:
+            options = {'lang': ocr_settings.language}
+            if ocr_settings.oem is not None:
+                options['oem'] = self.tesserocr.OEM(ocr_settings.oem)
+            self._local.engines[key] = self.tesserocr.PyTessBaseAPI(
+                **options)
+        engine = self._local.engines[key]
+        engine.SetPageSegMode(self.tesserocr.PSM.AUTO
+                              if ocr_settings.psm is None
+                              else self.tesserocr.PSM(ocr_settings.psm))
+        engine.SetVariable('tessedit_char_whitelist',
+                           ocr_settings.whitelist or '')
+        return engine
+
+    def ocr(self, png, out_file, timeout=None, ocr_settings=None):
+        """ OCRs a png image into `out_file`.txt. The timeout is ignored,
+        since libtesseract cannot be stopped from another thread """
+
+        engine = self.engine(ocr_settings)
+        engine.SetImageFile(png)
+        text = engine.GetUTF8Text()
+        with open(out_file + '.txt', 'w') as f:
+            f.write(text)
+
+    def detect_script(self, png, timeout=None):
+        """ Returns the script OSD detects on a page, or None if detection
+        fails """
+
+        if not hasattr(self._local, 'osd'):
+            self._local.osd = self.tesserocr.PyTessBaseAPI(
+                psm=self.tesserocr.PSM.OSD_ONLY)
+        self._local.osd.SetImageFile(png)
+        result = self._local.osd.DetectOrientationScript()
+        if result:
+            return result.get('script_name')
+        logging.warning("script detection failed on %s", png)
+
+
+OCR_BACKENDS = {
+    'cli': TesseractCLI,
+    'api': TesseractAPI,
+}
+
+
+def get_ocr_backend(name='auto', language='eng', ocr_settings=None):
+    """ Returns an OCR backend by name. `auto` uses the in process
+    TesseractAPI when tesserocr is installed and falls back to TesseractCLI
+    otherwise """
+
+    if name != 'auto':
+        return OCR_BACKENDS[name](language, ocr_settings)
+    if has_tesserocr():
+        return TesseractAPI(language, ocr_settings)
+    return TesseractCLI(language, ocr_settings)
+
+
+OCR_POOLS = {}
+OCR_POOLS_LOCK = threading.Lock()
+
+
+def get_ocr_pool(workers):
+    """ Returns the thread pool shared by all documents OCRed with `workers`
+    concurrent pages. Its threads live for the whole process, so the
+    engines TesseractAPI keeps per thread are loaded once, not per document
+    """
+
+    with OCR_POOLS_LOCK:
+        if workers not in OCR_POOLS:
+            OCR_POOLS[workers] = ThreadPoolExecutor(max_workers=workers)
+        return OCR_POOLS[workers]
+
+
+class OCRCache:
+    """ OCRCache stores the Tesseract output of rendered pages on local disk,
+    keyed on a hash of the page image, the OCR backend and the settings used.
+    Identical pages (blank pages, cover sheets, redaction notices) are only
+    OCRed once. The least recently used entries are evicted when the cache
+    grows past `max_bytes`. Entries may be evicted at any time by another
+    thread or process sharing `cache_dir`, which counts as a miss. """
+
+    def __init__(self, cache_dir, max_bytes=500 * 1024 * 1024):
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(stat.st_size for path, stat in self.entries())
+
+    def entries(self):
+        """ Returns the path and stat of each cached text file """
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.txt'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                entries.append((path, os.stat(path)))
+            except FileNotFoundError:
+                # Evicted since the directory was listed
+                pass
+        return entries
+
+    def key(self, png, settings, backend=''):
+        """ Returns a key made from the page image, the name of the OCR
+        backend, whose output differs slightly, and the OCR settings """
+
+        digest = hashlib.sha1()
+        with open(png, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        digest.update(backend.encode('utf-8') + b'\0')
+        digest.update(' '.join(settings).encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(self, key):
+        """ Returns the location of a cache entry """
+
+        return os.path.join(self.cache_dir, key + '.txt')
+
+    def get(self, key, out_file):
+        """ Copies a cached page to `out_file` and returns True on a hit """
+
+        cached = self.path(key)
+        try:
+            shutil.copyfile(cached, out_file)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return False
+        # Touch the entry so that eviction is least recently used, unless it
+        # was evicted since it was copied
+        try:
+            os.utime(cached)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def put(self, key, text_file):
+        """ Adds an OCRed page to the cache and evicts old entries """
+
+        cached = self.path(key)
+        temp_file = cached + '.%d.%d.tmp' % (
+            os.getpid(), threading.get_ident())
+        shutil.copyfile(text_file, temp_file)
+        os.replace(temp_file, cached)
+        with self.lock:
+            try:
+                self.size += os.path.getsize(cached)
+            except FileNotFoundError:
+                return
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """ Removes least recently used entries until the cache fits in
+        `max_bytes` """
+
+        entries = sorted(self.entries(), key=lambda e: e[1].st_mtime)
+        self.size = sum(stat.st_size for path, stat in entries)
+        for path, stat in entries:
+            if self.size <= self.max_bytes:
+                break
+            self.size -= stat.st_size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """ Returns hit and miss counts for this run """
+
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': self.size,
+        }
+
+
+class ScratchSpaceExceeded(Exception):
+    """ Raised when intermediate files outgrow their scratch space budget """
+
+
+class ScratchSpace:
+    """ ScratchSpace is a per-job temporary directory for intermediate files,
+    such as page images and per-page text, so they stay off the volume that
+    holds the documents. `base_dir` may point at a RAM disk like `/dev/shm`.
+    `max_bytes` caps what a job may write and `min_free_bytes` keeps
+    concurrent jobs from filling the scratch volume. """
+
+    def __init__(self, base_dir=None, max_bytes=None, min_free_bytes=0):
+
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.temp = tempfile.TemporaryDirectory(
+            prefix='textextraction-', dir=base_dir)
+        self.name = self.temp.name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+
+    def path(self, file_name):
+        """ Returns a location inside the scratch directory """
+
+        return os.path.join(self.name, file_name)
+
+    def used_bytes(self):
+        """ Returns the number of bytes currently in the scratch directory """
+
+        total = 0
+        for root, dirs, files in os.walk(self.name):
+            for file_name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, file_name))
+                except FileNotFoundError:
+                    pass
+        return total
+
+    def check(self):
+        """ Raises ScratchSpaceExceeded if the job is over budget or the
+        scratch volume is running out of space """
+
+        if self.max_bytes is not None:
+            used = self.used_bytes()
+            if used > self.max_bytes:
+                raise ScratchSpaceExceeded(
+                    '%s uses %d bytes, budget is %d' % (
+                        self.name, used, self.max_bytes))
+        if self.min_free_bytes:
+            free = shutil.disk_usage(self.name).free
+            if free < self.min_free_bytes:
+                raise ScratchSpaceExceeded(
+                    '%d bytes free on scratch volume, %d required' % (
+                        free, self.min_free_bytes))
+
+    def wait(self, process, poll_interval=0.5, timeout=None):
+        """ Waits for a process writing into scratch space and kills it if
+        the budget is exceeded or it runs longer than `timeout` seconds """
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return process.communicate(timeout=poll_interval)
+            except subprocess.TimeoutExpired:
+                try:
+                    self.check()
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise LimitExceeded(
+                            '%s took longer than %ss' % (
+                                os.path.basename(process.args[0]), timeout))
+                except (ScratchSpaceExceeded, LimitExceeded):
+                    process.kill()
+                    process.communicate()
+                    raise
+
+    def cleanup(self):
+        """ Removes the scratch directory and everything in it """
+
+        self.temp.cleanup()
+
+
+class TikaError(Exception):
+    """ Raised when Tika cannot extract a document, after retrying if the
+    failure looked temporary """
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class DocumentNotFound(Exception):
+    """ Raised when the document to extract does not exist """
+
+
+TIKA_LIMITERS = {}
+TIKA_LIMITERS_LOCK = threading.Lock()
+
+
+def get_tika_limiter(host='localhost', port=9998):
+    """ Returns the AdaptiveLimiter shared by all requests to a Tika server.
+    Its settings can be changed before extraction starts and its metrics()
+    report the current limit and queue depth """
+
+    with TIKA_LIMITERS_LOCK:
+        key = (host, int(port))
+        if key not in TIKA_LIMITERS:
+            TIKA_LIMITERS[key] = AdaptiveLimiter()
+        return TIKA_LIMITERS[key]
+
 
 class TextExtraction:
     """ The TextExtraction class contains functions for extracting and saving
     metadata and text from all files compatible with Apache Tika"""
 
-    def __init__(self, doc_path, tika_port=9998, host='localhost'):
+    # Retries after a temporary Tika failure and their backoff in seconds
+    TIKA_RETRIES = 4
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 30.0
+    # curl exit codes for failed connections and dropped replies
+    RETRY_EXIT_CODES = (7, 52, 55, 56)
+    # curl exit code when a request runs past --max-time
+    TIMEOUT_EXIT_CODE = 28
+    # Size of the reads from a Tika response
+    READ_CHUNK = 64 * 1024
+
+    def __init__(self, doc_path, tika_port=9998, host='localhost',
+                 scratch_dir=None, scratch_max_bytes=None, catalog=None,
+                 limits=None, scratch_min_free_bytes=0):
+        """
+        scratch_max_bytes: most bytes this job may write to scratch space
+        scratch_min_free_bytes: free bytes to leave on the scratch volume,
+        shared by every concurrent job
+        """
 
+        self.catalog = catalog
+        self.limits = limits or ResourceLimits()
+        self.tika_limiter = get_tika_limiter(host, tika_port)
+        self.profile = None
+        self.tika_metadata = None
+        self.scratch_dir = scratch_dir
+        self.scratch_max_bytes = scratch_max_bytes
+        self.scratch_min_free_bytes = scratch_min_free_bytes
+        self._scratch = None
         self.doc_path = doc_path
         self.root, self.extension = os.path.splitext(doc_path)
         self.tika_port = tika_port
@@ -31,6 +519,37 @@ class TextExtraction:
         self.metadata_args = ['curl', '-T', doc_path,
                               'http://%s:%s/meta' % (host, tika_port),
                               '-s', '--header', 'Accept: application/json']
+        if self.limits.tika_timeout is not None:
+            for args in (self.text_args, self.metadata_args):
+                args.extend(['--max-time', str(self.limits.tika_timeout)])
+
+    @property
+    def scratch(self):
+        """ Scratch space for intermediate files, created on first use """
+
+        if self._scratch is None:
+            self._scratch = ScratchSpace(
+                self.scratch_dir, self.scratch_max_bytes,
+                self.scratch_min_free_bytes)
+        return self._scratch
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """ Times a tool run for the DocumentProfile of this document, when
+        it is being profiled """
+
+        if self.profile is None:
+            yield
+        else:
+            with self.profile.timed(name):
+                yield
+
+    def cleanup(self):
+        """ Removes intermediate files """
+
+        if self._scratch is not None:
+            self._scratch.cleanup()
+            self._scratch = None
 
     def save(self, document, ext):
         """ Save document to root location """
@@ -40,10 +559,91 @@ class TextExtraction:
         with open(export_path, 'w') as f:
             f.write(document)
 
+    def input_size(self):
+        """ Returns the size of the document in bytes """
+
+        return os.path.getsize(self.doc_path)
+
+    def check_input_size(self):
+        """ Raises LimitExceeded if the document is larger than allowed """
+
+        max_bytes = self.limits.max_input_bytes
+        if max_bytes is not None:
+            size = self.input_size()
+            if size > max_bytes:
+                raise LimitExceeded('%s is %d bytes, limit is %d' % (
+                    self.doc_path, size, max_bytes))
+
+    def read_output(self, process):
+        """ Reads a Tika response from curl, killing curl and raising
+        LimitExceeded once the response outgrows max_text_bytes """
+
+        max_bytes = self.limits.max_text_bytes
+        chunks = []
+        size = 0
+        for chunk in iter(lambda: process.stdout.read(self.READ_CHUNK), b''):
+            chunks.append(chunk)
+            size += len(chunk)
+            # The response ends with a newline and a 3 digit status code
+            if max_bytes is not None and size > max_bytes + 4:
+                process.kill()
+                process.communicate()
+                raise LimitExceeded('%s: extracted text is over %d bytes' % (
+                    self.doc_path, max_bytes))
+        return b''.join(chunks)
+
+    def send_to_tika(self, args):
+        """ Runs a curl request against the Tika server """
+
+        process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        output = self.read_output(process)
+        if process.wait():
+            raise subprocess.CalledProcessError(process.returncode, args)
+        return output
+
+    def run_tika(self, args):
+        """ Sends the document to the Tika server and returns the response.
+        Requests wait for a slot from the server's limiter, and server errors,
+        timeouts and dropped connections are retried with jittered backoff """
+
+        args = args + ['-w', '\n%{http_code}']
+        for attempt in range(self.TIKA_RETRIES + 1):
+            start = self.tika_limiter.acquire()
+            retry = False
+            timed_out = False
+            try:
+                with self.timed('tika'):
+                    output = self.send_to_tika(args)
+            except subprocess.CalledProcessError as e:
+                retry = e.returncode in self.RETRY_EXIT_CODES
+                timed_out = e.returncode == self.TIMEOUT_EXIT_CODE
+                error = TikaError('%s: curl exited with %d' % (
+                    self.doc_path, e.returncode))
+                if timed_out:
+                    error = LimitExceeded('%s: Tika took longer than %ss' % (
+                        self.doc_path, self.limits.tika_timeout))
+            else:
+                document, _, status = output.rpartition(b'\n')
+                status = int(status or 0)
+                if status < 400:
+                    return document
+                retry = status >= 500 or status == 429
+                error = TikaError('%s: Tika responded %d' % (
+                    self.doc_path, status), status)
+            finally:
+                # Timeouts slow the server down but are not retried, since
+                # they are more often caused by the document than by load
+                self.tika_limiter.release(start, ok=not (retry or timed_out))
+            if not retry or attempt == self.TIKA_RETRIES:
+                raise error
+            delay = backoff_delay(attempt, self.BACKOFF_BASE, self.BACKOFF_MAX)
+            logging.warning("%s, retrying in %.1fs", error, delay)
+            time.sleep(delay)
+
     def doc_to_text(self):
         """ Converts a document to text using the Tika server """
 
-        document = subprocess.check_output(self.text_args)
+        document = self.run_tika(self.text_args)
         logging.info("%s converted to text from pdf", self.doc_path)
         return document
 
@@ -52,8 +652,17 @@ class TextExtraction:
         Extracts metadata using Tika into a json file
         """
 
-        metadata = subprocess.check_output(self.metadata_args)
+        metadata = self.run_tika(self.metadata_args)
         self.save(metadata.decode('utf-8'), ext='_metadata.json')
+        try:
+            self.tika_metadata = json.loads(metadata.decode('utf-8'))
+        except ValueError:
+            self.tika_metadata = {}
+        if self.catalog:
+            metadata_file = self.root + '_metadata.json'
+            self.catalog.record_raw(
+                metadata_file, metadata.decode('utf-8'),
+                os.path.getmtime(metadata_file))
 
     def extract(self):
         """
@@ -61,8 +670,12 @@ class TextExtraction:
         with Tika, (http://tika.apache.org/1.7/formats.html) but does not
         check if extraction produces text.
         """
-        self.extract_metadata()
-        self.save(self.doc_to_text().decode('utf-8'), ext='.txt')
+        try:
+            self.check_input_size()
+            self.extract_metadata()
+            self.save(self.doc_to_text().decode('utf-8'), ext='.txt')
+        finally:
+            self.cleanup()
 
 
 class PDFTextExtraction(TextExtraction):
@@ -70,12 +683,28 @@ class PDFTextExtraction(TextExtraction):
     functionality is triggered only if a PDF document is not responsive or
     if Tika fails to extract text """
 
-    def __init__(self, doc_path, tika_port=9998,
-                 host='localhost', word_threshold=10):
+    WORDS = WORDS
 
-        super().__init__(doc_path, tika_port, host)
-        self.WORDS = re.compile('[A-Za-z]{3,}')
+    def __init__(self, doc_path, tika_port=9998,
+                 host='localhost', word_threshold=10, ocr_cache=None,
+                 ocr_backend=None, scratch_dir=None, scratch_max_bytes=None,
+                 duplicate_index=None, catalog=None, limits=None,
+                 ocr_settings=None, ocr_workers=1, scratch_min_free_bytes=0):
+        """
+        ocr_settings: OCRSettings for this document, defaults to those of
+        the OCR backend
+        ocr_workers: number of pages OCRed at the same time
+        """
+        super().__init__(doc_path, tika_port, host, scratch_dir,
+                         scratch_max_bytes, catalog, limits,
+                         scratch_min_free_bytes)
         self.word_threshold = word_threshold
+        self.ocr_cache = ocr_cache
+        self.ocr_backend = ocr_backend or get_ocr_backend()
+        self.duplicate_index = duplicate_index
+        self.ocr_settings = ocr_settings or self.ocr_backend.ocr_settings
+        self.ocr_workers = ocr_workers
+        self._document_settings = None
 
     def meets_len_threshold(self, doc_text):
         """
@@ -98,7 +727,10 @@ class PDFTextExtraction(TextExtraction):
             stdout=subprocess.PIPE,
         )
         result = None
-        if pdffonts_output.communicate()[0].decode("utf-8").count("\n") > 2:
+        with self.timed('pdffonts'):
+            output = communicate(
+                pdffonts_output, args, self.limits.pdffonts_timeout)[0]
+        if output.decode("utf-8").count("\n") > 2:
             result = True
         retcode = pdffonts_output.returncode
         if retcode:
@@ -115,81 +747,350 @@ class PDFTextExtraction(TextExtraction):
                 shutil.copyfileobj(source, append)
         os.remove(out_file)
 
+    def ocr_page(self, png, out_file):
+        """ Uses Tesseract OCR to convert one png page to `out_file`.txt,
+        reusing cached text when the same page has been seen before """
+
+        ocr_settings = self.document_settings()
+        cache_key = None
+        if self.ocr_cache:
+            cache_key = self.ocr_cache.key(
+                png, self.ocr_backend.settings(ocr_settings),
+                self.ocr_backend.name)
+            if self.ocr_cache.get(cache_key, out_file + '.txt'):
+                return
+        with self.timed('tesseract'):
+            self.ocr_backend.ocr(
+                png, out_file, self.limits.tesseract_timeout, ocr_settings)
+        self.scratch.check()
+        if cache_key:
+            self.ocr_cache.put(cache_key, out_file + '.txt')
+
+    def document_settings(self):
+        """ Returns the OCR settings for this document. With detect_script,
+        the first page is rendered once and its script picks the languages
+        """
+
+        if self._document_settings is None:
+            ocr_settings = self.ocr_settings
+            if ocr_settings.detect_script:
+                png = self.page_root() + '_001.png'
+                if not os.path.exists(png):
+                    self.pdf_to_img(last_page=1)
+                with self.timed('osd'):
+                    script = self.ocr_backend.detect_script(
+                        png, self.limits.tesseract_timeout)
+                ocr_settings = ocr_settings.for_script(script)
+                logging.info("%s is in %s script, OCR languages %s",
+                             self.doc_path, script, ocr_settings.language)
+            self._document_settings = ocr_settings
+        return self._document_settings
+
+    def page_root(self):
+        """ Returns the scratch location used for page images and text """
+
+        return self.scratch.path(os.path.basename(self.root))
+
+    def check_text_size(self, text_file):
+        """ Removes the partial OCR text and raises LimitExceeded if it has
+        outgrown max_text_bytes """
+
+        max_bytes = self.limits.max_text_bytes
+        if max_bytes is not None and os.path.getsize(text_file) > max_bytes:
+            os.remove(text_file)
+            raise LimitExceeded('%s: extracted text is over %d bytes' % (
+                self.doc_path, max_bytes))
+
     def img_to_text(self):
         """ Uses Tesseract OCR to convert png image to text file """
 
         main_text_file = self.root + '.txt'
-        for png in sorted(glob.glob('%s_*.png' % self.root)):
-            out_file = png[:-4]
-            args = ['tesseract', png, out_file, '-l', 'eng']
-            doc_process = subprocess.Popen(
-                args=args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            doc_process.communicate()
-            if doc_process.returncode:
-                raise subprocess.CalledProcessError(doc_process.returncode,
-                                                    args)
-            self.cat_and_clean(out_file, main_text_file)
+        pages = sorted(glob.glob('%s_*.png' % self.page_root()))
+        # Pages may already have been OCRed for duplicate detection
+        todo = [png for png in pages if not os.path.exists(png[:-4] + '.txt')]
+        if self.ocr_workers > 1 and len(todo) > 1:
+            # Settings are chosen before pages are OCRed concurrently
+            self.document_settings()
+            pool = get_ocr_pool(self.ocr_workers)
+            for future in [pool.submit(self.ocr_page, png, png[:-4])
+                           for png in todo]:
+                future.result()
+        else:
+            for png in todo:
+                self.ocr_page(png, png[:-4])
+        for png in pages:
+            self.cat_and_clean(png[:-4], main_text_file)
+            self.check_text_size(main_text_file)
 
         logging.info("%s converted to text from image", self.root + '.png')
+        if self.ocr_cache:
+            logging.info("OCR cache stats: %s", self.ocr_cache.stats())
         return main_text_file
 
-    def pdf_to_img(self):
-        """ Converts and saves pdf file to png image using Ghostscript"""
+    def pdf_to_img(self, last_page=None, first_page=None, page_root=None):
+        """ Converts and saves pdf file to png image using Ghostscript. Pages
+        are numbered from 001 in `page_root`, whatever the first page """
 
-        export_path = self.root + "_%03d.png"
+        export_path = (page_root or self.page_root()) + "_%03d.png"
         args = [
             'gs', '-dNOPAUSE', '-dBATCH', '-sDEVICE=pnggray',
             '-dINTERPOLATE', '-r300', '-dNumRenderingThreads=8',
             '-sOutputFile={0}'.format(export_path), self.doc_path
         ]
-        process = subprocess.Popen(
-            args=args, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-        process.communicate()
+        if first_page:
+            args.insert(-1, '-dFirstPage=%d' % first_page)
+        if last_page:
+            args.insert(-1, '-dLastPage=%d' % last_page)
+        with self.timed('ghostscript'):
+            process = subprocess.Popen(
+                args=args, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+            self.scratch.wait(
+                process, timeout=self.limits.ghostscript_timeout)
         if process.returncode:
             raise subprocess.CalledProcessError(process.returncode, args)
         logging.info("%s converted to png images", self.doc_path)
         return export_path
 
+    def document_id(self):
+        """ Returns the id of this document in the duplicate index """
+
+        return self.root
+
+    def read_saved_text(self, doc_id):
+        """ Returns the extracted text of an indexed document, if any """
+
+        text_file = doc_id + '.txt'
+        if os.path.exists(text_file):
+            with open(text_file, 'r') as f:
+                return f.read()
+
+    def page_count(self):
+        """ Returns the number of pages Tika reported, or None """
+
+        pages = (self.tika_metadata or {}).get('xmpTPg:NPages')
+        if isinstance(pages, list):
+            pages = pages[0] if pages else None
+        try:
+            return int(pages)
+        except (TypeError, ValueError):
+            return None
+
+    def page_signature(self, page, page_root):
+        """ Renders and OCRs one page into `page_root` and returns its
+        MinHash signature """
+
+        self.pdf_to_img(last_page=page, first_page=page, page_root=page_root)
+        out_file = page_root + '_001'
+        self.ocr_page(out_file + '.png', out_file)
+        with open(out_file + '.txt', 'r') as f:
+            return self.duplicate_index.signature(f.read())
+
+    def first_page_signature(self):
+        """ Renders and OCRs only the first page and returns its MinHash
+        signature """
+
+        return self.page_signature(1, self.page_root())
+
+    def last_page_signature(self):
+        """ Returns the MinHash signature of the last OCRed page """
+
+        pages = sorted(glob.glob('%s_*.png' % self.page_root()))
+        if pages:
+            with open(pages[-1][:-4] + '.txt', 'r') as f:
+                return self.duplicate_index.signature(f.read())
+
+    def copy_near_duplicate(self, signature):
+        """ Saves the text of an already processed document whose first page
+        matches this one. Documents often share a cover sheet or form, so the
+        match must also have the same page count and, for documents of more
+        than one page, a matching last page. Returns True if text was copied
+        """
+
+        pages = self.page_count()
+        if pages is None:
+            return False
+        match = self.duplicate_index.query(
+            signature, self.document_id(), pages)
+        if not match:
+            return False
+        if pages > 1:
+            last_signature = self.duplicate_index.last_signature(match)
+            if last_signature is None or similarity(
+                    self.page_signature(pages, self.page_root() + '-last'),
+                    last_signature) < self.duplicate_index.threshold:
+                logging.info("%s shares a first page with %s but differs",
+                             self.doc_path, match)
+                return False
+        text = self.read_saved_text(match)
+        if text is None:
+            return False
+        self.save(text, ext='.txt')
+        logging.info("%s is a near-duplicate of %s, skipped OCR",
+                     self.doc_path, match)
+        return True
+
     def extract(self):
         """
         Converts pdfs to text and extracts metadata. Uses OCR if the
         initial attempt fails.
         """
 
-        self.extract_metadata()
-        needs_ocr = False
-        # Determine if PDF has text
-        if not self.has_text():
-            needs_ocr = True
-        else:
-            doc_text = self.doc_to_text().decode('utf-8')
-            # Determine if extraction suceeded
-            if self.meets_len_threshold(doc_text):
-                self.save(doc_text, ext='.txt')
-            else:
+        try:
+            self.check_input_size()
+            self.extract_metadata()
+            needs_ocr = False
+            # Determine if PDF has text
+            if not self.has_text():
                 needs_ocr = True
-        if needs_ocr:
-            self.pdf_to_img()
-            self.img_to_text()
+            else:
+                doc_text = self.doc_to_text().decode('utf-8')
+                # Determine if extraction suceeded
+                if self.meets_len_threshold(doc_text):
+                    self.save(doc_text, ext='.txt')
+                else:
+                    needs_ocr = True
+            if needs_ocr:
+                signature = None
+                if self.duplicate_index:
+                    signature = self.first_page_signature()
+                    if self.copy_near_duplicate(signature):
+                        return
+                self.pdf_to_img()
+                self.img_to_text()
+                if self.duplicate_index:
+                    self.duplicate_index.add(
+                        self.document_id(), signature, self.page_count(),
+                        self.last_page_signature())
+        finally:
+            self.cleanup()
 
 
 class TextExtractionS3(TextExtraction):
 
-    def __init__(self, file_key, s3_bucket, tika_port=9998, host='localhost'):
-        """ Connects to s3 bucket and downloads file into a temp dir
-        before using super to initalize like TextExtraction """
+    # Size of the chunks streamed from s3 into Tika
+    STREAM_CHUNK = 1024 * 1024
+
+    def __init__(self, file_key, s3_bucket, tika_port=9998, host='localhost',
+                 scratch_dir=None, scratch_max_bytes=None, stream=False,
+                 limits=None, scratch_min_free_bytes=0):
+        """ Connects to s3 bucket and downloads file into scratch space
+        before using super to initalize like TextExtraction. With `stream`,
+        the file is only downloaded when a tool needs a local copy and Tika
+        reads it straight from s3 """
 
         self.file_key = file_key
         self.s3_bucket = s3_bucket
+        self._input_size = None
+
+        self.temp = ScratchSpace(
+            scratch_dir, scratch_max_bytes, scratch_min_free_bytes)
+        doc_path = self.temp.path(os.path.basename(file_key))
+
+        # Keywords, since with PDFTextExtractionS3 this reaches
+        # PDFTextExtraction, whose positional arguments differ
+        super().__init__(doc_path, tika_port=tika_port, host=host,
+                         scratch_dir=scratch_dir,
+                         scratch_max_bytes=scratch_max_bytes, limits=limits,
+                         scratch_min_free_bytes=scratch_min_free_bytes)
+        # Intermediate files share the download's scratch space, so the
+        # document counts against the job's budget
+        self._scratch = self.temp
+        if not stream:
+            try:
+                self.materialize()
+            except Exception:
+                self.cleanup()
+                raise
+
+    def cleanup(self):
+        """ Removes intermediate files and the downloaded document """
+
+        super().cleanup()
+        self.temp.cleanup()
+
+    def input_size(self):
+        """ Returns the size of the s3 object in bytes, looked up once """
+
+        if self._input_size is None:
+            k = self.s3_bucket.get_key(self.file_key)
+            if k is None:
+                raise DocumentNotFound('%s is not in s3' % self.file_key)
+            self._input_size = k.size
+        return self._input_size
+
+    def s3_error(self, error):
+        """ Returns DocumentNotFound for an s3 error about a missing object
+        and the error itself otherwise """
+
+        from boto.exception import S3ResponseError
+        if isinstance(error, S3ResponseError) and error.status == 404:
+            return DocumentNotFound('%s is not in s3' % self.file_key)
+        return error
 
-        self.temp = tempfile.TemporaryDirectory()
-        doc_path = os.path.join(self.temp.name, os.path.basename(file_key))
+    def materialize(self):
+        """ Downloads the document from s3 into scratch space, if it is not
+        already local and not over the input size limit """
 
-        k = Key(self.s3_bucket)
-        k.key = self.file_key
-        k.get_contents_to_filename(doc_path)
+        if not os.path.exists(self.doc_path):
+            self.check_input_size()
+            with self.timed('s3'):
+                try:
+                    s3_key(self.s3_bucket, self.file_key)\
+                        .get_contents_to_filename(self.doc_path)
+                except Exception as e:
+                    raise self.s3_error(e)
+            self.scratch.check()
 
-        super().__init__(doc_path, tika_port, host)
+    def send_to_tika(self, args):
+        """ Sends the local copy of the document to Tika or, if there is no
+        local copy, streams the s3 object into the request body """
+
+        if os.path.exists(self.doc_path):
+            return super().send_to_tika(args)
+        return self.stream_to_tika(args)
+
+    def stream_to_tika(self, args):
+        """ Pipes the s3 object into curl in chunks, so neither local disk
+        nor memory holds the whole document. Each call is a new GET of the
+        object: one for metadata, one for text and one per retry """
+
+        args = ['-' if arg == self.doc_path else arg for arg in args]
+        k = s3_key(self.s3_bucket, self.file_key)
+        process = subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        errors = []
+
+        def write_body():
+            try:
+                for chunk in iter(lambda: k.read(self.STREAM_CHUNK), b''):
+                    process.stdin.write(chunk)
+            except BrokenPipeError:
+                pass
+            except Exception as e:
+                errors.append(e)
+                process.kill()
+            finally:
+                # fast, so a request that stopped early does not read the
+                # rest of the object just to close it
+                k.close(fast=True)
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        writer = threading.Thread(target=write_body)
+        writer.start()
+        try:
+            output = self.read_output(process)
+        finally:
+            writer.join()
+        process.wait()
+        if errors:
+            raise self.s3_error(errors[0])
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, args)
+        logging.info("%s streamed from s3 to Tika", self.file_key)
+        return output
 
     def save(self, document, ext):
         """ Save document to s3 """
@@ -197,19 +1098,59 @@ class TextExtractionS3(TextExtraction):
         root, old_ext = os.path.splitext(self.file_key)
         s3_path = root + ext
 
-        k = Key(self.s3_bucket)
-        k.key = s3_path
-        k.set_contents_from_string(str(document))
+        s3_key(self.s3_bucket, s3_path).set_contents_from_string(
+            str(document))
 
 
 class PDFTextExtractionS3(TextExtractionS3, PDFTextExtraction):
 
     def __init__(self, file_key, s3_bucket, tika_port=9998, host='localhost',
-                 word_threshold=10):
+                 word_threshold=10, ocr_cache=None, ocr_backend=None,
+                 scratch_dir=None, scratch_max_bytes=None,
+                 duplicate_index=None, stream=False, limits=None,
+                 ocr_settings=None, ocr_workers=1, scratch_min_free_bytes=0):
 
-        TextExtractionS3.__init__(self, file_key, s3_bucket, tika_port, host)
-        self.WORDS = re.compile('[A-Za-z]{3,}')
+        TextExtractionS3.__init__(self, file_key, s3_bucket, tika_port, host,
+                                  scratch_dir, scratch_max_bytes, stream,
+                                  limits, scratch_min_free_bytes)
         self.word_threshold = word_threshold
+        self.ocr_cache = ocr_cache
+        self.ocr_backend = ocr_backend or get_ocr_backend()
+        self.duplicate_index = duplicate_index
+        self.ocr_settings = ocr_settings or self.ocr_backend.ocr_settings
+        self.ocr_workers = ocr_workers
+        self._document_settings = None
+
+    def document_id(self):
+        """ Returns the s3 key of this document without its extension """
+
+        return os.path.splitext(self.file_key)[0]
+
+    def send_to_tika(self, args):
+        """ Downloads the document before the first Tika request, as pdffonts
+        needs a local copy anyway and streaming would fetch it twice """
+
+        self.materialize()
+        return super().send_to_tika(args)
+
+    def read_saved_text(self, doc_id):
+        """ Returns the extracted text of an indexed document from s3 """
+
+        k = self.s3_bucket.get_key(doc_id + '.txt')
+        if k:
+            return k.get_contents_as_string().decode('utf-8')
+
+    def has_text(self):
+        """ Downloads the document for pdffonts before checking for text """
+
+        self.materialize()
+        return super().has_text()
+
+    def pdf_to_img(self, last_page=None, first_page=None, page_root=None):
+        """ Downloads the document for Ghostscript before rendering it """
+
+        self.materialize()
+        return super().pdf_to_img(last_page, first_page, page_root)
 
     def img_to_text(self):
         """ Extends img_to_text from PDFTextExtraction and adds a s3 save
@@ -219,36 +1160,95 @@ class PDFTextExtractionS3(TextExtractionS3, PDFTextExtraction):
         local_base, text_file_name = os.path.split(main_text_file)
         s3_base, s3_doc_name = os.path.split(self.file_key)
 
-        k = Key(self.s3_bucket)
-        k.key = os.path.join(s3_base, text_file_name)
+        k = s3_key(self.s3_bucket, os.path.join(s3_base, text_file_name))
         k.set_contents_from_filename(main_text_file)
 
 
-def text_extractor(doc_path, force_convert=False):
+def run_extractor(make_extractor, doc_path, quarantine=None, profiler=None):
+    """ Creates and runs an extractor. With a quarantine, a failure caused
+    by the document is recorded there instead of raised, so a batch moves
+    on. Tika being unreachable is not the document's fault and is raised.
+    With a DocumentProfiler, the document is profiled """
+
+    try:
+        if profiler is None:
+            make_extractor().extract()
+        else:
+            with profiler.profile(doc_path) as profile:
+                extractor = make_extractor()
+                extractor.profile = profile
+                extractor.extract()
+    except (LimitExceeded, TikaError, ScratchSpaceExceeded,
+            DocumentNotFound, subprocess.CalledProcessError) as e:
+        unreachable = isinstance(e, TikaError) and e.status is None
+        if quarantine is None or unreachable:
+            raise
+        quarantine.add(doc_path, e)
+
+
+def text_extractor(doc_path, force_convert=False, ocr_cache=None,
+                   ocr_backend=None, scratch_dir=None, scratch_max_bytes=None,
+                   duplicate_index=None, catalog=None, limits=None,
+                   quarantine=None, ocr_settings=None, ocr_workers=1,
+                   profiler=None, scratch_min_free_bytes=0):
     """Checks if document has been converted and sends file to appropriate
-    converter"""
+    converter. Documents in the quarantine are skipped"""
 
+    if quarantine is not None and doc_path in quarantine:
+        logging.info("%s is quarantined", doc_path)
+        return
     root, extension = os.path.splitext(doc_path)
     if not os.path.exists(root + ".txt") or force_convert:
         if extension == '.pdf':
-            extractor = PDFTextExtraction(doc_path)
+            make_extractor = functools.partial(
+                PDFTextExtraction, doc_path, ocr_cache=ocr_cache,
+                ocr_backend=ocr_backend,
+                scratch_dir=scratch_dir, scratch_max_bytes=scratch_max_bytes,
+                duplicate_index=duplicate_index, catalog=catalog,
+                limits=limits, ocr_settings=ocr_settings,
+                ocr_workers=ocr_workers,
+                scratch_min_free_bytes=scratch_min_free_bytes)
         else:
-            extractor = TextExtraction(doc_path)
-        extractor.extract()
+            make_extractor = functools.partial(
+                TextExtraction, doc_path, scratch_dir=scratch_dir,
+                scratch_max_bytes=scratch_max_bytes, catalog=catalog,
+                limits=limits, scratch_min_free_bytes=scratch_min_free_bytes)
+        run_extractor(make_extractor, doc_path, quarantine, profiler)
 
 
-def text_extractor_s3(file_key, s3_bucket, force_convert=True):
+def text_extractor_s3(file_key, s3_bucket, force_convert=True,
+                      ocr_cache=None, ocr_backend=None, scratch_dir=None,
+                      scratch_max_bytes=None, duplicate_index=None,
+                      stream=True, limits=None, quarantine=None,
+                      ocr_settings=None, ocr_workers=1, profiler=None,
+                      scratch_min_free_bytes=0):
     """ Checks if document has been converted in s3 bucket and and sends file
-    to appropriate converter"""
+    to appropriate converter. With `stream`, documents other than PDFs are
+    streamed into Tika without being downloaded, at the cost of reading the
+    object from s3 for every Tika request (at least two) instead of once.
+    PDFs are always downloaded once, since pdffonts and Ghostscript need a
+    local file. Documents in the quarantine are skipped """
 
+    if quarantine is not None and file_key in quarantine:
+        logging.info("%s is quarantined", file_key)
+        return
     root, extension = os.path.splitext(file_key)
     if not force_convert:
         if len(list(s3_bucket.list(root + '.txt'))) > 0:
             logging.info("%s has already been converted", file_key)
             return
     if extension == ".pdf":
-        extractor = PDFTextExtractionS3(file_key, s3_bucket)
+        make_extractor = functools.partial(
+            PDFTextExtractionS3, file_key, s3_bucket, ocr_cache=ocr_cache,
+            ocr_backend=ocr_backend, scratch_dir=scratch_dir,
+            scratch_max_bytes=scratch_max_bytes,
+            duplicate_index=duplicate_index, stream=stream, limits=limits,
+            ocr_settings=ocr_settings, ocr_workers=ocr_workers,
+            scratch_min_free_bytes=scratch_min_free_bytes)
     else:
-        extractor = TextExtractionS3(file_key, s3_bucket)
+        make_extractor = functools.partial(
+            TextExtractionS3, file_key, s3_bucket, scratch_dir=scratch_dir,
+            scratch_max_bytes=scratch_max_bytes, stream=stream, limits=limits,
+            scratch_min_free_bytes=scratch_min_free_bytes)
     logging.info("%s is being converted", file_key)
-    extractor.extract()
+    run_extractor(make_extractor, file_key, quarantine, profiler)
@@ -0,0 +1,108 @@
+import random
+import threading
+import time
+
+
+"""
+Adaptive concurrency control for requests to a shared server such as Tika.
+The limit on in-flight requests grows additively while requests succeed and
+is cut multiplicatively on errors or slow responses (AIMD), so clients settle
+near what the server can handle instead of a hand-tuned worker count.
+"""
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """ Returns a randomized delay before retry number `attempt` (from 0),
+    drawn between zero and an exponentially growing ceiling ("full jitter")
+    so that clients that failed together do not retry together """
+
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class AdaptiveLimiter:
+    """ AdaptiveLimiter bounds the number of requests in flight. acquire()
+    blocks while the limit is reached and release() reports how the request
+    went: each success adds `increase / limit` (about `increase` per full
+    window of requests), while a failure, or a response slower than
+    `target_latency` seconds when one is set, multiplies the limit by
+    `decrease`. Cuts happen at most once per average latency, so a burst of
+    failures from one overloaded moment only backs off once. """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=64, increase=1.0,
+                 decrease=0.5, target_latency=None, smoothing=0.2):
+
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.waiting = 0
+        self.requests = 0
+        self.errors = 0
+        self.latency = None
+        self.error_rate = 0.0
+        self.last_decrease = float('-inf')
+        self.condition = threading.Condition()
+
+    def available(self):
+        """ Returns True if another request may start """
+
+        return self.in_flight < max(self.min_limit, int(self.limit))
+
+    def acquire(self):
+        """ Waits for a free slot and returns the request's start time, which
+        is passed back to release() """
+
+        with self.condition:
+            self.waiting += 1
+            try:
+                self.condition.wait_for(self.available)
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, start, ok=True):
+        """ Frees a slot and adjusts the limit from the request's outcome """
+
+        now = time.monotonic()
+        latency = now - start
+        with self.condition:
+            self.in_flight -= 1
+            self.requests += 1
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.smoothing * (latency - self.latency)
+            failed = 0.0 if ok else 1.0
+            self.error_rate += self.smoothing * (failed - self.error_rate)
+            slow = (self.target_latency is not None and
+                    latency > self.target_latency)
+            if not ok:
+                self.errors += 1
+            if not ok or slow:
+                if now - self.last_decrease >= self.latency:
+                    self.limit = max(
+                        self.min_limit, self.limit * self.decrease)
+                    self.last_decrease = now
+            else:
+                self.limit = min(
+                    self.max_limit, self.limit + self.increase / self.limit)
+            self.condition.notify_all()
+
+    def metrics(self):
+        """ Returns the current limit, load and smoothed request outcomes """
+
+        with self.condition:
+            return {
+                'limit': max(self.min_limit, int(self.limit)),
+                'in_flight': self.in_flight,
+                'queue_depth': self.waiting,
+                'latency': self.latency,
+                'error_rate': self.error_rate,
+                'requests': self.requests,
+                'errors': self.errors,
+            }
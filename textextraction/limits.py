@@ -0,0 +1,98 @@
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import time
+
+
+"""
+Per-document resource limits, so that one pathological file (a zip bomb, a
+huge spreadsheet, a malformed PDF) is killed and set aside instead of
+hanging or exhausting the worker that picked it up.
+"""
+
+
+class LimitExceeded(Exception):
+    """ Raised when a document runs over one of its ResourceLimits """
+
+
+class ResourceLimits:
+    """ ResourceLimits holds the wall-clock timeouts, in seconds, of each
+    extraction tool and the largest input document and extracted text, in
+    bytes, that a worker accepts. None disables a limit. Tesseract's timeout
+    applies per page and only to the command line backend, since in process
+    OCR cannot be interrupted. """
+
+    def __init__(self, tika_timeout=600, ghostscript_timeout=900,
+                 tesseract_timeout=300, pdffonts_timeout=60,
+                 max_input_bytes=None, max_text_bytes=None):
+
+        self.tika_timeout = tika_timeout
+        self.ghostscript_timeout = ghostscript_timeout
+        self.tesseract_timeout = tesseract_timeout
+        self.pdffonts_timeout = pdffonts_timeout
+        self.max_input_bytes = max_input_bytes
+        self.max_text_bytes = max_text_bytes
+
+
+def communicate(process, args, timeout=None):
+    """ Waits for a process like Popen.communicate, but kills it and raises
+    LimitExceeded if it runs longer than `timeout` seconds """
+
+    try:
+        return process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise LimitExceeded(
+            '%s took longer than %ss' % (os.path.basename(args[0]), timeout))
+
+
+class Quarantine:
+    """ Quarantine records documents that failed extraction as one JSON file
+    each in `directory`, so a batch can move on and later runs can skip them
+    until the record is removed. Documents themselves are left in place. """
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, doc_path):
+        """ Returns the record location of a document """
+
+        name = hashlib.sha1(doc_path.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.json')
+
+    def __contains__(self, doc_path):
+        return os.path.exists(self.path(doc_path))
+
+    def add(self, doc_path, error):
+        """ Records why a document failed """
+
+        record = {
+            'doc_path': doc_path,
+            'error': type(error).__name__,
+            'message': str(error),
+            'time': time.time(),
+        }
+        with open(self.path(doc_path), 'w') as f:
+            json.dump(record, f)
+        logging.warning("%s quarantined: %s", doc_path, error)
+
+    def remove(self, doc_path):
+        """ Releases a document so it is extracted again """
+
+        if doc_path in self:
+            os.remove(self.path(doc_path))
+
+    def records(self):
+        """ Returns the failure records sorted by time """
+
+        records = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith('.json'):
+                with open(os.path.join(self.directory, file_name)) as f:
+                    records.append(json.load(f))
+        return sorted(records, key=lambda record: record['time'])
@@ -0,0 +1,145 @@
+import contextlib
+import cProfile
+import hashlib
+import json
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+
+
+"""
+Opt-in profiling of slow documents. Every document processed under a
+DocumentProfiler runs with cProfile and its external tool runs (Tika,
+Ghostscript, Tesseract, pdffonts) are timed. Only documents slower than the
+threshold keep their profile, and report() ranks them at the end of a run.
+"""
+
+
+class DocumentProfile:
+    """ DocumentProfile collects the cProfile of one document and the wall
+    clock time of each external tool it ran """
+
+    def __init__(self, doc_id):
+
+        self.doc_id = doc_id
+        self.profile = cProfile.Profile()
+        self.commands = []
+        self.seconds = None
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """ Times a tool run. Pages OCRed concurrently are each recorded """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.commands.append((name, time.perf_counter() - start))
+
+    def command_totals(self):
+        """ Returns the number of runs and total seconds of each tool """
+
+        totals = {}
+        for name, seconds in self.commands:
+            total = totals.setdefault(name, {'count': 0, 'seconds': 0.0})
+            total['count'] += 1
+            total['seconds'] += seconds
+        for total in totals.values():
+            total['seconds'] = round(total['seconds'], 3)
+        return totals
+
+
+class DocumentProfiler:
+    """ DocumentProfiler profiles documents and keeps a `.prof` file (for
+    pstats, snakeviz or flameprof), a text summary of the slowest functions
+    and the tool timings of every document that takes at least `threshold`
+    seconds. Artifacts are written to `output_dir`. """
+
+    def __init__(self, output_dir, threshold=10.0, top_functions=30):
+
+        self.output_dir = output_dir
+        self.threshold = threshold
+        self.top_functions = top_functions
+        self.documents = 0
+        self.slow = []
+        self.lock = threading.Lock()
+        os.makedirs(output_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def profile(self, doc_id):
+        """ Profiles the document processed inside the block and yields its
+        DocumentProfile """
+
+        document = DocumentProfile(doc_id)
+        try:
+            document.profile.enable()
+            profiling = True
+        except ValueError:
+            # Python 3.12+ allows one active profiler, so concurrent
+            # documents fall back to tool timings only
+            profiling = False
+        start = time.perf_counter()
+        try:
+            yield document
+        finally:
+            if profiling:
+                document.profile.disable()
+            document.seconds = time.perf_counter() - start
+            self.finish(document, profiling)
+
+    def artifact_path(self, doc_id, ext):
+        """ Returns a file name for a document's artifacts that is readable
+        and unique """
+
+        name = re.sub(r'[^A-Za-z0-9._-]+', '_', doc_id).strip('_')[-80:]
+        digest = hashlib.sha1(doc_id.encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.output_dir, '%s-%s%s' % (name, digest, ext))
+
+    def finish(self, document, profiling):
+        """ Saves the artifacts of a document over the threshold """
+
+        with self.lock:
+            self.documents += 1
+        if document.seconds < self.threshold:
+            return
+        record = {
+            'doc_id': document.doc_id,
+            'seconds': round(document.seconds, 3),
+            'commands': document.command_totals(),
+            'profile': None,
+        }
+        if profiling:
+            record['profile'] = self.artifact_path(document.doc_id, '.prof')
+            document.profile.dump_stats(record['profile'])
+            summary = self.artifact_path(document.doc_id, '.txt')
+            with open(summary, 'w') as f:
+                stats = pstats.Stats(document.profile, stream=f)
+                stats.sort_stats('cumulative').print_stats(
+                    self.top_functions)
+        with self.lock:
+            self.slow.append(record)
+        logging.info("%s took %.1fs, profile saved", document.doc_id,
+                     document.seconds)
+
+    def report(self):
+        """ Writes slow_documents.json, with slow documents ranked from the
+        slowest, and returns the ranking """
+
+        with self.lock:
+            ranked = sorted(
+                self.slow, key=lambda record: record['seconds'],
+                reverse=True)
+            report = {
+                'threshold': self.threshold,
+                'documents': self.documents,
+                'slow_documents': ranked,
+            }
+        with open(os.path.join(self.output_dir, 'slow_documents.json'),
+                  'w') as f:
+            json.dump(report, f, indent=2)
+        return ranked